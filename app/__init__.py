@@ -2,12 +2,14 @@ import logging
 import os
 from logging.handlers import RotatingFileHandler
 
-from flask import Flask
+from flask import Flask, current_app, request
+from flask_babel import Babel
 from flask_login import LoginManager
 from flask_mail import Mail
 from flask_migrate import Migrate
 from flask_moment import Moment
 from flask_sqlalchemy import SQLAlchemy
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 from config import Config
 
@@ -18,17 +20,40 @@ db = SQLAlchemy()
 migrate = Migrate()
 mail = Mail()
 moment = Moment()
+babel = Babel()
+
+
+def get_locale():
+    return request.accept_languages.best_match(current_app.config['LANGUAGES'])
 
 
 def create_app(config_class=Config):
     app = Flask(__name__)
     app.config.from_object(config_class)
+    if app.config['PROXY_FIX_X_FOR']:
+        app.wsgi_app = ProxyFix(app.wsgi_app,
+                                x_for=app.config['PROXY_FIX_X_FOR'])
+
+    from app import engine  # noqa
+    engine.init_app(app)
 
     login.init_app(app)
     db.init_app(app)
+    engine.init_engines(app)
+    from app import instrumentation  # noqa
+    instrumentation.init_app(app)
     migrate.init_app(app, db)
     mail.init_app(app)
     moment.init_app(app)
+    babel.init_app(app, locale_selector=get_locale)
+
+    from app import language  # noqa
+    language.init_app(app)
+    # Registers the session events that keep the search and username
+    # indexes, the page cache and the identity cache current
+    from app import autocomplete, identity, page_cache, search  # noqa
+    app.jinja_env.globals['render_post'] = page_cache.render_post
+    autocomplete.init_app(app)
 
     # Middle import to avoid circular dependencies
     from app.errors import bp as errors_bp  # noqa
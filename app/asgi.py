@@ -0,0 +1,131 @@
+"""ASGI serving mode.
+
+`uvicorn asgi:app` serves the same application as `flask run`, except that
+the translation endpoints are answered by the coroutines below instead of
+the Flask views. They await the translator backend, so one process keeps
+many slow DeepL round-trips in flight without holding a thread for each.
+Every other request is passed to the Flask app through asgiref's WsgiToAsgi
+adapter. Needs the asgiref and httpx packages, plus an ASGI server.
+
+The coroutines never query the database themselves: every query goes
+through asgiref's sync_to_async, which runs them one at a time on a single
+thread, so the session is never used concurrently.
+"""
+import json
+
+from asgiref.sync import sync_to_async
+from flask_login import current_user
+
+from app import db
+from app.translate_service import (batch_items, stored_translations,
+                                   translate_async, translate_posts_async)
+
+
+async def translate_text(data):
+    """Async variant of main.translate_text."""
+    if data.get('post_id'):
+        # Posts translated in the background are a plain lookup
+        item = (int(data['post_id']), data['dest_lang'])
+        stored = await sync_to_async(stored_translations)([item])
+        if item in stored:
+            return {'text': stored[item]}
+    text = await translate_async(data['text'], data['source_lang'],
+                                 data['dest_lang'])
+    await sync_to_async(db.session.commit)()
+    return {'text': text}
+
+
+async def translate_batch(data):
+    """Async variant of main.translate_batch. Language pairs are translated
+    concurrently."""
+    translations = await translate_posts_async(batch_items(data))
+    await sync_to_async(db.session.commit)()
+    return {'translations': translations}
+
+
+class AsyncApp:
+    """ASGI application wrapping the Flask app `app`."""
+
+    # POST endpoints served natively, by path
+    views = {
+        '/translate': translate_text,
+        '/translate/batch': translate_batch,
+    }
+    # Served only to logged in users, like their Flask views
+    login_required = {'/translate/batch'}
+
+    def __init__(self, app):
+        self.app = app
+        self._wsgi = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http' and scope['method'] == 'POST' and \
+                scope['path'] in self.views:
+            await self._view(scope, receive, send)
+        else:
+            if self._wsgi is None:
+                from asgiref.wsgi import WsgiToAsgi
+                self._wsgi = WsgiToAsgi(self.app)
+            await self._wsgi(scope, receive, send)
+
+    async def _view(self, scope, receive, send):
+        view = self.views[scope['path']]
+        body = b''
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+
+        with self.app.app_context():
+            if scope['path'] in self.login_required and \
+                    not await sync_to_async(self._authenticated)(scope):
+                status, payload = 401, {'error': 'Unauthorized'}
+            else:
+                status, payload = await self._call(view, body)
+
+        body = json.dumps(payload).encode()
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(b'content-type', b'application/json'),
+                        (b'content-length', str(len(body)).encode())],
+        })
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def _call(self, view, body):
+        try:
+            data = json.loads(body)
+            if not isinstance(data, dict):
+                raise ValueError('expected a JSON object')
+            return 200, await view(data)
+        except (KeyError, TypeError, ValueError):
+            return 400, {'error': 'Bad Request'}
+        except Exception:
+            self.app.logger.exception('Async view failed')
+            return 500, {'error': 'Internal Server Error'}
+
+    def _authenticated(self, scope):
+        """Whether the session cookie sent with the request `scope` belongs
+        to a logged in user."""
+        headers = [(name.decode('latin-1'), value.decode('latin-1'))
+                   for name, value in scope.get('headers', ())]
+        with self.app.test_request_context(scope['path'], method='POST',
+                                           headers=headers):
+            return current_user.is_authenticated
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                translator = self.app.extensions.get('translator')
+                if translator is not None:
+                    await translator.aclose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
@@ -4,12 +4,14 @@ import sqlalchemy as sa
 from flask import flash, redirect, render_template, request, url_for
 from flask_login import current_user, login_user, logout_user
 
-from app import db
+from app import db, identity, metrics
 from app.auth import bp
 from app.auth.forms import (LoginForm, RegistrationForm, ResetPasswordForm,
                             ResetPasswordRequestForm)
 from app.models import User
 from app.auth.email import send_password_reset_email
+from app.auth.throttle import login_throttles
+from app.passwords import needs_rehash
 
 
 @bp.route('/login', methods=['GET', 'POST'])
@@ -24,6 +26,17 @@ def login():
     # Check if form is submitted with data and passes the validations
     if form.validate_on_submit():
 
+        # Too many recent failures for this name or address are turned away
+        # before any password hash is computed
+        by_username, by_ip = login_throttles()
+        username = form.username.data.lower()
+        if by_username.blocked(username) or \
+                by_ip.blocked(request.remote_addr):
+            metrics.incr('login_throttled')
+            flash("Too many failed login attempts, please try again later")
+            return render_template('auth/login.html', title='Sign In',
+                                   form=form), 429
+
         # Executes the query and returns a single scalar value
         user = db.session.scalar(
             sa.select(User).where(User.username == form.username.data)
@@ -31,8 +44,17 @@ def login():
 
         # Checks if user exists and password is correct
         if (user is None) or (not user.check_password(form.password.data)):
+            by_username.hit(username)
+            by_ip.hit(request.remote_addr)
             flash("Invalid username or password")
             return redirect(url_for('auth.login'))
+        by_username.reset(username)
+
+        # Upgrade hashes made with older parameters while the password is
+        # at hand
+        if needs_rehash(user.password_hash):
+            user.set_password(form.password.data)
+            db.session.commit()
 
         # Registers the user as logged in
         login_user(user, remember=form.remember_me.data)
@@ -52,6 +74,8 @@ def login():
 
 @bp.route('/logout')
 def logout():
+    if current_user.is_authenticated:
+        identity.invalidate(current_user.id)
     logout_user()
     return redirect(url_for('main.index'))
 
@@ -85,6 +109,8 @@ def reset_password_request():
         )
         if user:
             send_password_reset_email(user)
+            # Commits the email when it is queued in the outbox
+            db.session.commit()
         flash("If your email is correct, the instructions to change "
               "your password is sent to your email.")
         return redirect(url_for('auth.login'))
@@ -0,0 +1,69 @@
+import threading
+from collections import deque
+from time import monotonic
+
+from flask import current_app
+
+
+class SlidingWindow:
+    """Counts events per key, like failed logins per username, over the
+    last `window` seconds.
+
+    Only the latest `limit` events of a key are kept, which is all it
+    takes to tell whether the key is over the limit. Keys without recent
+    events are swept out once per window. Counts live in the process, so
+    with several workers a client gets up to `limit` events per worker."""
+
+    def __init__(self, limit, window):
+        self.limit = limit
+        self.window = window
+        self._events = {}
+        self._lock = threading.Lock()
+        self._swept_at = monotonic()
+
+    def _recent(self, key, now):
+        events = self._events.get(key)
+        if events is not None:
+            while events and events[0] <= now - self.window:
+                events.popleft()
+        return events
+
+    def blocked(self, key):
+        """Tells whether `key` has reached the limit."""
+        with self._lock:
+            events = self._recent(key, monotonic())
+            return events is not None and len(events) >= self.limit
+
+    def hit(self, key):
+        now = monotonic()
+        with self._lock:
+            events = self._recent(key, now)
+            if events is None:
+                events = self._events[key] = deque(maxlen=self.limit)
+            events.append(now)
+            if now - self._swept_at > self.window:
+                self._sweep(now)
+
+    def reset(self, key):
+        with self._lock:
+            self._events.pop(key, None)
+
+    def _sweep(self, now):
+        for key in [key for key, events in self._events.items()
+                    if not events or events[-1] <= now - self.window]:
+            del self._events[key]
+        self._swept_at = now
+
+
+def login_throttles():
+    """Returns the (per username, per IP address) failed login windows of
+    the current app."""
+    throttles = current_app.extensions.get('login_throttles')
+    if throttles is None:
+        config = current_app.config
+        window = config['LOGIN_FAILURE_WINDOW']
+        throttles = current_app.extensions['login_throttles'] = (
+            SlidingWindow(config['LOGIN_MAX_FAILURES_PER_USERNAME'], window),
+            SlidingWindow(config['LOGIN_MAX_FAILURES_PER_IP'], window),
+        )
+    return throttles
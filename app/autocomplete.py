@@ -0,0 +1,190 @@
+import heapq
+import threading
+from bisect import bisect_left, insort
+from time import monotonic, sleep
+
+import sqlalchemy as sa
+from flask import current_app
+
+from app import db
+from app.cache import LRUCache
+from app.commit_hooks import subscribe
+from app.models import User
+
+
+class UsernameIndex:
+    """In-process prefix index over User.username.
+
+    Usernames are kept lowercased in a sorted list, so all names starting
+    with a prefix form one contiguous slice found with two bisections.
+    Matches are ranked by follower count. Short prefixes match a large
+    share of all users, so their answers are memoized until the index
+    changes.
+
+    Every add() and remove() bumps a generation counter. While a rebuild
+    is loading the user table they are also logged, and the ones made
+    after it started are re-applied to the new lists, so they are not lost
+    when the lists are swapped in."""
+
+    def __init__(self, memo_size=1024):
+        self._lock = threading.Lock()
+        self.keys = []
+        self.users = {}
+        self._memo = LRUCache(memo_size)
+        self._generation = 0
+        self._builds = 0
+        self._pending = []
+        self.built_at = None
+
+    def build(self):
+        """Loads every username and follower count from the database."""
+        with self._lock:
+            self._builds += 1
+            since = self._generation
+        try:
+            rows = db.session.execute(
+                sa.select(User.id, User.username, User.num_followers)).all()
+        except BaseException:
+            with self._lock:
+                self._end_build()
+            raise
+        keys = sorted((username.lower(), id) for id, username, _ in rows)
+        users = {id: (username, followers)
+                 for id, username, followers in rows}
+        with self._lock:
+            self.keys, self.users = keys, users
+            for generation, id, username, followers in self._pending:
+                if generation > since:
+                    self._apply(id, username, followers)
+            self._end_build()
+            self._memo.clear()
+            self.built_at = monotonic()
+
+    def _end_build(self):
+        self._builds -= 1
+        if not self._builds:
+            self._pending.clear()
+
+    def add(self, id, username, followers=0):
+        with self._lock:
+            self._log(id, username, followers)
+            self._apply(id, username, followers)
+
+    def remove(self, id):
+        with self._lock:
+            self._log(id, None, 0)
+            self._apply(id, None, 0)
+
+    def _log(self, id, username, followers):
+        self._generation += 1
+        if self._builds:
+            self._pending.append(
+                (self._generation, id, username, followers))
+
+    def _apply(self, id, username, followers):
+        self._remove(id)
+        if username is not None:
+            insort(self.keys, (username.lower(), id))
+            self.users[id] = (username, followers)
+
+    def _remove(self, id):
+        self._memo.clear()
+        if id not in self.users:
+            return
+        username, _ = self.users.pop(id)
+        key = (username.lower(), id)
+        i = bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            del self.keys[i]
+
+    def complete(self, prefix, limit):
+        """Returns up to `limit` (username, followers) pairs for the users
+        whose name starts with `prefix`, most followed first."""
+        prefix = prefix.lower()
+        with self._lock:
+            memo = self._memo.get(prefix)
+            # A memo with fewer matches than its limit holds all of them
+            if memo is not None and (memo[0] >= limit
+                                     or len(memo[1]) < memo[0]):
+                return memo[1][:limit]
+            start = bisect_left(self.keys, (prefix,))
+            # Every key with the prefix sorts below prefix + U+10FFFF
+            end = bisect_left(self.keys, (prefix + '\U0010ffff',), start)
+            matches = heapq.nlargest(
+                limit, (self.users[id] for _, id in self.keys[start:end]),
+                key=lambda user: (user[1], user[0]))
+            if len(prefix) <= 2:
+                self._memo.set(prefix, (limit, matches))
+        return matches
+
+
+def init_app(app):
+    """Builds the username index of the app at startup, on a background
+    thread that rebuilds it every USERNAME_INDEX_TTL seconds to pick up
+    changed follower counts, so no request has to scan the user table."""
+    index = app.extensions['username_index'] = UsernameIndex()
+    if app.config['USERNAME_INDEX_PRELOAD']:
+        threading.Thread(target=_refresh, args=(app, index), daemon=True,
+                         name='username-index').start()
+
+
+def _refresh(app, index):
+    while True:
+        with app.app_context():
+            try:
+                index.build()
+            except sa.exc.DBAPIError as e:
+                # The user table may not have been created yet
+                app.logger.warning('Could not build the username index: %s',
+                                   e)
+            finally:
+                db.session.remove()
+        sleep(app.config['USERNAME_INDEX_TTL'])
+
+
+def get_index():
+    """Returns the username index of the current app. Without
+    USERNAME_INDEX_PRELOAD, it is built on first use."""
+    index = current_app.extensions.get('username_index')
+    if index is None:
+        index = current_app.extensions['username_index'] = UsernameIndex()
+    if index.built_at is None:
+        index.build()
+    return index
+
+
+def complete_username(prefix, limit):
+    return get_index().complete(prefix, limit)
+
+
+# New users and username changes are collected on flush and applied to the
+# index once the transaction commits.
+
+def _collect(session, changes):
+    if 'username_index' not in current_app.extensions:
+        return
+    for obj in session.new:
+        if isinstance(obj, User):
+            changes.append((obj.id, obj.username))
+    for obj in session.dirty:
+        if isinstance(obj, User) and \
+                sa.inspect(obj).attrs.username.history.has_changes():
+            changes.append((obj.id, obj.username))
+    for obj in session.deleted:
+        if isinstance(obj, User):
+            changes.append((obj.id, None))
+
+
+def _apply(changes):
+    if not changes:
+        return
+    index = current_app.extensions['username_index']
+    for id, username in changes:
+        if username is None:
+            index.remove(id)
+        else:
+            followers = index.users.get(id, (None, 0))[1]
+            index.add(id, username, followers)
+
+
+subscribe('username_changes', list, _collect, _apply)
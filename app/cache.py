@@ -0,0 +1,46 @@
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+
+class LRUCache:
+    """A thread-safe, size-bounded mapping that forgets the least recently
+    used entries first. Entries older than `ttl` seconds are treated as
+    missing; a `ttl` of None keeps them until they are pushed out."""
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, stored_at = self._data[key]
+            except KeyError:
+                return default
+            if self.ttl is not None and monotonic() - stored_at > self.ttl:
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, monotonic())
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
@@ -0,0 +1,46 @@
+"""Acting on database changes once they are committed.
+
+The in-process caches and indexes mirror rows of the database, so they can
+only take a change into account after its transaction commits. Each of them
+subscribes here: what every flush changed is collected into session.info,
+applied after the commit and thrown away on rollback.
+"""
+import sqlalchemy as sa
+
+from app import db
+
+_subscribers = []
+
+
+def subscribe(key, factory, collect, apply):
+    """Registers a subscriber keeping its changes in session.info[key].
+
+    After each flush, `collect(session, changes)` records what the flush
+    changed into `changes`, made with `factory()` on the first flush of the
+    transaction. Once the transaction commits, `apply(changes)` is called;
+    a rollback discards them."""
+    _subscribers.append((key, factory, collect, apply))
+
+
+@sa.event.listens_for(db.session, 'after_flush')
+def _after_flush(session, flush_context):
+    for key, factory, collect, _ in _subscribers:
+        changes = session.info.get(key)
+        if changes is None:
+            changes = session.info[key] = factory()
+        collect(session, changes)
+
+
+@sa.event.listens_for(db.session, 'after_commit')
+def _after_commit(session):
+    # Popped first, so changes are never applied twice if a subscriber fails
+    pending = [(apply, session.info.pop(key))
+               for key, _, _, apply in _subscribers if key in session.info]
+    for apply, changes in pending:
+        apply(changes)
+
+
+@sa.event.listens_for(db.session, 'after_soft_rollback')
+def _after_rollback(session, previous_transaction):
+    for key, _, _, _ in _subscribers:
+        session.info.pop(key, None)
@@ -2,15 +2,146 @@
 # from app import sg
 # from sendgrid.helpers.mail import Mail
 
-from app import mail
+import atexit
+import queue
+import threading
+import uuid
+from datetime import datetime, timedelta, timezone
+from time import perf_counter, sleep
+
+import sqlalchemy as sa
+from app import db, mail, metrics
+from app.instrumentation import timed
+from app.models import Outbox
 from flask import current_app
 from flask_mail import Message
-from threading import Thread
 
+# Placed on the queue once per worker to make it exit
+_STOP = object()
+
+
+class MailDispatcher:
+    """Delivers emails from a bounded queue with a fixed pool of worker
+    threads.
+
+    Each worker takes whatever messages are waiting, up to MAIL_BATCH_SIZE,
+    and sends them over a single SMTP connection. Failed messages are
+    retried on a new connection with exponential backoff."""
+
+    def __init__(self, app):
+        self.app = app
+        self.queue = queue.Queue(app.config['MAIL_QUEUE_SIZE'])
+        self.threads = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self.threads:
+                return
+            for i in range(self.app.config['MAIL_WORKERS']):
+                thread = threading.Thread(
+                    target=self._work, name=f'mail-worker-{i}', daemon=True)
+                thread.start()
+                self.threads.append(thread)
+        atexit.register(self.shutdown)
+
+    def submit(self, msg):
+        """Queues `msg`. When the queue is full, waits up to
+        MAIL_QUEUE_TIMEOUT seconds for room and then drops the message."""
+        self.start()
+        try:
+            self.queue.put(msg, timeout=self.app.config['MAIL_QUEUE_TIMEOUT'])
+        except queue.Full:
+            metrics.incr('mail_dropped')
+            self.app.logger.error('Mail queue is full, dropped email to %s',
+                                  msg.recipients)
+
+    def depth(self):
+        """Number of messages waiting to be sent."""
+        return self.queue.qsize()
+
+    def join(self):
+        """Blocks until every queued message has been handled."""
+        self.queue.join()
 
-def send_async_email(app, msg):
-    with app.app_context():
-        mail.send(msg)
+    def shutdown(self, timeout=30):
+        """Sends what is left in the queue, then stops the workers."""
+        with self._lock:
+            threads, self.threads = self.threads, []
+        for _ in threads:
+            self.queue.put(_STOP)
+        for thread in threads:
+            thread.join(timeout)
+
+    def _work(self):
+        with self.app.app_context():
+            while True:
+                batch, stop = self._next_batch()
+                if batch:
+                    self._deliver(batch)
+                for _ in range(len(batch) + stop):
+                    self.queue.task_done()
+                if stop:
+                    return
+
+    def _next_batch(self):
+        """Waits for a message, then takes any others already queued."""
+        batch = []
+        msg = self.queue.get()
+        while msg is not _STOP:
+            batch.append(msg)
+            if len(batch) >= self.app.config['MAIL_BATCH_SIZE']:
+                return batch, False
+            try:
+                msg = self.queue.get_nowait()
+            except queue.Empty:
+                return batch, False
+        return batch, True
+
+    def _deliver(self, messages):
+        config = self.app.config
+        for attempt in range(config['MAIL_MAX_RETRIES'] + 1):
+            if attempt:
+                sleep(config['MAIL_RETRY_DELAY'] * 2 ** (attempt - 1))
+            messages = send_messages(messages)
+            if not messages:
+                return
+        metrics.incr('mail_failed', len(messages))
+        self.app.logger.error('Giving up on %d emails', len(messages))
+
+
+def send_messages(messages):
+    """Sends `messages` over one SMTP connection and returns the ones that
+    could not be sent."""
+    sent = set()
+    failed = []
+    try:
+        with timed('smtp'), mail.connect() as conn:
+            for msg in messages:
+                start = perf_counter()
+                try:
+                    conn.send(msg)
+                except Exception as e:
+                    current_app.logger.warning('Sending email failed: %s', e)
+                    failed.append(msg)
+                    continue
+                sent.add(id(msg))
+                metrics.incr('mail_sent')
+                metrics.incr('mail_send_seconds', perf_counter() - start)
+    except Exception as e:
+        # Connecting or closing the connection failed
+        current_app.logger.warning('SMTP connection failed: %s', e)
+        return [msg for msg in messages if id(msg) not in sent]
+    return failed
+
+
+def get_dispatcher(app=None):
+    """Returns the mail dispatcher of `app` (the current app by default)."""
+    app = app or current_app._get_current_object()
+    dispatcher = app.extensions.get('mail_dispatcher')
+    if dispatcher is None:
+        dispatcher = app.extensions['mail_dispatcher'] = MailDispatcher(app)
+    return dispatcher
 
 
 def send_email(subject, recipients, sender, html_body, text_body):
@@ -21,10 +152,7 @@ def send_email(subject, recipients, sender, html_body, text_body):
     )
     msg.html = html_body
     msg.body = text_body
-    Thread(
-        target=send_async_email,
-        args=(current_app._get_current_object(), msg)
-        ).start()
+    send_messages_later([msg])
 
     # # This block is configuration is for SendGrid which is disabled for now
     # message = Mail(
@@ -41,3 +169,132 @@ def send_email(subject, recipients, sender, html_body, text_body):
     #     print(response.headers)
     # except Exception as e:
     #     print(e)
+
+
+def send_messages_later(messages):
+    """Hands `messages` to the outbox or to the mail dispatcher."""
+    if current_app.config['MAIL_OUTBOX']:
+        # Stored with the caller's transaction and sent by `flask outbox`
+        db.session.add_all(Outbox(
+            subject=msg.subject, recipients=msg.recipients,
+            sender=msg.sender, html_body=msg.html, text_body=msg.body
+        ) for msg in messages)
+        return
+    dispatcher = get_dispatcher()
+    for msg in messages:
+        dispatcher.submit(msg)
+
+
+class EmailComposer:
+    """Renders one email, from a `<template>.txt` and `<template>.html`
+    pair, for many recipients.
+
+    The templates are loaded once and rendered straight from the Jinja
+    environment, skipping the per-call lookup, context processors and
+    signals of render_template(). Templates get `user` plus the keyword
+    arguments of compose(); they can't rely on request globals."""
+
+    def __init__(self, template, subject, sender=None):
+        env = current_app.jinja_env
+        self.text_template = env.get_template(f'{template}.txt')
+        self.html_template = env.get_template(f'{template}.html')
+        self.subject = subject
+        self.sender = sender or current_app.config['ADMINS'][0]
+
+    def compose(self, users, **context):
+        """Returns one Message per user."""
+        messages = []
+        for user in users:
+            context['user'] = user
+            msg = Message(subject=self.subject, recipients=[user.email],
+                          sender=self.sender)
+            msg.body = self.text_template.render(context)
+            msg.html = self.html_template.render(context)
+            messages.append(msg)
+        return messages
+
+
+def claim_outbox(limit):
+    """Leases up to `limit` due outbox rows to this worker and returns them.
+
+    On Postgres the due rows are locked with SELECT ... FOR UPDATE SKIP
+    LOCKED, so concurrent workers claim disjoint batches. SQLite runs one
+    writer at a time, so a single UPDATE ... WHERE id IN (...) is enough
+    there."""
+    now = datetime.now(timezone.utc)
+    token = uuid.uuid4().hex
+    lease = timedelta(seconds=current_app.config['MAIL_OUTBOX_LEASE'])
+    due = (
+        sa.select(Outbox.id)
+        .where(Outbox.status == 'pending',
+               sa.or_(Outbox.leased_until.is_(None),
+                      Outbox.leased_until < now))
+        .order_by(Outbox.id)
+        .limit(limit)
+    )
+    if db.engine.dialect.name == 'postgresql':
+        due = db.session.scalars(due.with_for_update(skip_locked=True)).all()
+    else:
+        due = due.scalar_subquery()
+    db.session.execute(
+        sa.update(Outbox)
+        .where(Outbox.id.in_(due))
+        .values(leased_until=now + lease, lease_token=token)
+    )
+    db.session.commit()
+    return db.session.scalars(
+        sa.select(Outbox).where(Outbox.lease_token == token,
+                                Outbox.status == 'pending')
+    ).all()
+
+
+def process_outbox(limit=None):
+    """Sends one claimed batch of outbox rows. Returns the number of rows
+    that were claimed."""
+    config = current_app.config
+    rows = claim_outbox(limit or config['MAIL_BATCH_SIZE'])
+    if not rows:
+        return 0
+    messages = {}
+    for row in rows:
+        msg = Message(subject=row.subject, recipients=row.recipients,
+                      sender=row.sender)
+        msg.html = row.html_body
+        msg.body = row.text_body
+        messages[id(msg)] = (row, msg)
+    failed = {id(msg) for msg in send_messages(
+        [msg for _, msg in messages.values()])}
+
+    now = datetime.now(timezone.utc)
+    for key, (row, msg) in messages.items():
+        row.attempts += 1
+        if key not in failed:
+            row.status = 'sent'
+            row.sent_at = now
+        elif row.attempts >= config['MAIL_MAX_RETRIES'] + 1:
+            row.status = 'failed'
+            metrics.incr('mail_failed')
+        else:
+            # Retry once the backoff has passed
+            delay = config['MAIL_RETRY_DELAY'] * 2 ** (row.attempts - 1)
+            row.leased_until = now + timedelta(seconds=delay)
+    db.session.commit()
+    return len(rows)
+
+
+def drain_outbox():
+    """Sends due outbox rows until none are left. Returns how many rows were
+    processed."""
+    total = 0
+    while True:
+        count = process_outbox()
+        if not count:
+            return total
+        total += count
+
+
+def work_outbox(poll_interval):
+    """Sends outbox rows forever, sleeping when nothing is due."""
+    while True:
+        if not process_outbox():
+            sleep(poll_interval)
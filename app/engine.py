@@ -0,0 +1,98 @@
+"""Database engine setup.
+
+init_app() runs before db.init_app(). It swaps in a connection pool that
+records how long checkouts wait, and registers a connect event applying
+SQLITE_PRAGMAS on SQLite and DB_STATEMENT_TIMEOUT on Postgres and MySQL to
+every new connection. pool_stats() reports how full the pool is, to size
+DB_POOL_SIZE and DB_MAX_OVERFLOW against the number of worker threads.
+"""
+from time import perf_counter
+
+import sqlalchemy as sa
+from sqlalchemy.pool import QueuePool
+
+from app import db, metrics
+
+# Engine options that only make sense for a QueuePool
+POOL_OPTIONS = ('pool_size', 'max_overflow', 'pool_timeout', 'pool_use_lifo')
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool counting checkouts, the time they wait for a connection
+    and how often they find the pool full."""
+
+    def _do_get(self):
+        start = perf_counter()
+        try:
+            connection = super()._do_get()
+        except sa.exc.TimeoutError:
+            metrics.incr('db_pool_timeouts')
+            raise
+        finally:
+            metrics.incr('db_pool_wait_seconds', perf_counter() - start)
+        metrics.incr('db_pool_checkouts')
+        if self._max_overflow >= 0 and \
+                self.checkedout() >= self.size() + self._max_overflow:
+            metrics.incr('db_pool_saturated')
+        return connection
+
+
+def _in_memory(url):
+    return url.get_backend_name() == 'sqlite' and \
+        url.database in (None, '', ':memory:')
+
+
+def init_app(app):
+    options = dict(app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+    url = sa.engine.make_url(app.config['SQLALCHEMY_DATABASE_URI'])
+    if _in_memory(url):
+        # Flask-SQLAlchemy keeps in-memory databases on a single connection
+        for key in POOL_OPTIONS:
+            options.pop(key, None)
+    else:
+        options.setdefault('poolclass', TimedQueuePool)
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = options
+
+
+def init_engines(app):
+    """Registers the connect event on the engines created by
+    db.init_app()."""
+    with app.app_context():
+        for engine in db.engines.values():
+            sa.event.listen(engine, 'connect',
+                            _connect_listener(engine.dialect.name,
+                                              app.config))
+
+
+def _connect_listener(dialect, config):
+    pragmas = config['SQLITE_PRAGMAS']
+    timeout = config['DB_STATEMENT_TIMEOUT']
+
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        if dialect == 'sqlite':
+            for name, value in pragmas.items():
+                cursor.execute(f'PRAGMA {name} = {value}')
+        elif timeout and dialect == 'postgresql':
+            cursor.execute(f'SET statement_timeout = {int(timeout)}')
+            dbapi_connection.commit()
+        elif timeout and dialect in ('mysql', 'mariadb'):
+            cursor.execute(f'SET SESSION max_execution_time = {int(timeout)}')
+            dbapi_connection.commit()
+        cursor.close()
+    return on_connect
+
+
+def pool_stats():
+    """Returns the size of the connection pool, the connections checked out
+    right now and their share of the most the pool will open
+    ('saturation'), along with the checkout counters."""
+    pool = db.engine.pool
+    stats = {key: metrics.get(key) for key in (
+        'db_pool_checkouts', 'db_pool_wait_seconds', 'db_pool_saturated',
+        'db_pool_timeouts')}
+    if isinstance(pool, QueuePool):
+        capacity = pool.size() + max(pool._max_overflow, 0)
+        stats.update(size=pool.size(), checked_out=pool.checkedout(),
+                     saturation=pool.checkedout() / capacity)
+    return stats
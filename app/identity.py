@@ -0,0 +1,90 @@
+import sqlalchemy as sa
+import sqlalchemy.orm as so
+from flask import current_app, session
+
+from app import db, login, metrics
+from app.cache import LRUCache
+from app.commit_hooks import subscribe
+from app.models import User
+
+# Never kept in the cache; it is loaded from the database on first access
+_UNCACHED = {'password_hash'}
+
+
+def get_cache():
+    """Returns the identity cache of the current app: for each user id, the
+    profile_version and column values of the user, kept for
+    IDENTITY_CACHE_TTL seconds."""
+    cache = current_app.extensions.get('identity_cache')
+    if cache is None:
+        cache = LRUCache(current_app.config['IDENTITY_CACHE_SIZE'],
+                         ttl=current_app.config['IDENTITY_CACHE_TTL'])
+        current_app.extensions['identity_cache'] = cache
+    return cache
+
+
+def _values(user):
+    return {attr.key: getattr(user, attr.key)
+            for attr in sa.inspect(User).column_attrs
+            if attr.key not in _UNCACHED}
+
+
+def invalidate(id):
+    if 'identity_cache' in current_app.extensions:
+        current_app.extensions['identity_cache'].delete(id)
+
+
+# When you reference current_user, Flask-Login will invoke the user loader
+# callback function with the value of User.get_id() stored in the session,
+# "<id>:<profile_version>".
+@login.user_loader
+def load_user(user_id):
+    """Returns the logged in user, from the identity cache when the cached
+    entry has the profile_version the session was keyed with, so warm
+    requests don't query the user table.
+
+    A cached user is rebuilt from its column values and added to the
+    session as if it had been loaded, so it can be changed and committed
+    like any other. Sessions keyed with an older version are moved to the
+    current one."""
+    id, _, version = user_id.partition(':')
+    id = int(id)
+    key = db.session.identity_key(User, id)
+    enabled = current_app.config['IDENTITY_CACHE_ENABLED']
+    if enabled and key not in db.session.identity_map:
+        cached = get_cache().get(id)
+        if cached is not None and str(cached[0]) == version:
+            metrics.incr('identity_cache_hits')
+            user = User(**cached[1])
+            so.make_transient_to_detached(user)
+            db.session.add(user)
+            return user
+        metrics.incr('identity_cache_misses')
+    user = db.session.get(User, id)
+    if user is None:
+        return None
+    if enabled:
+        get_cache().set(id, (user.profile_version, _values(user)))
+    if str(user.profile_version) != version:
+        session['_user_id'] = user.get_id()
+    return user
+
+
+# Any change to a user row drops its cached copy once the transaction
+# commits. This covers profile edits, password resets, follower counts and
+# last_seen writes.
+
+def _collect(session, changed):
+    if 'identity_cache' not in current_app.extensions:
+        return
+    for obj in session.dirty | session.deleted:
+        if isinstance(obj, User):
+            changed.add(obj.id)
+
+
+def _apply(changed):
+    for id in changed:
+        invalidate(id)
+
+
+subscribe('identity_changes', set, _collect, _apply)
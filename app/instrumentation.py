@@ -0,0 +1,172 @@
+"""Per-request timing and SQL instrumentation.
+
+Each request collects the time spent in SQL statements, template rendering
+and outbound calls (the translator backend, SMTP). The totals are sent back
+in a Server-Timing header, which browser dev tools show next to the request.
+With REQUEST_LOG they are also logged as one JSON line per request. The
+process-wide counters of app.metrics, which these timings feed, can be
+served in the Prometheus text format at /metrics, see METRICS_ENDPOINT.
+
+Statements slower than SLOW_QUERY_THRESHOLD seconds and requests slower than
+SLOW_REQUEST_THRESHOLD seconds are logged as warnings.
+"""
+import hmac
+import json
+import logging
+from contextlib import contextmanager
+from time import perf_counter
+
+import sqlalchemy as sa
+from flask import (Response, abort, before_render_template, current_app,
+                   g, has_request_context, request, template_rendered)
+
+from app import db, metrics
+from app.engine import pool_stats
+
+request_logger = logging.getLogger('app.requests')
+slow_query_logger = logging.getLogger('app.slow_queries')
+
+
+def record(name, seconds, calls=1):
+    """Adds a timing to the counters, and to the current request if there
+    is one."""
+    metrics.incr(f'{name}_calls', calls)
+    metrics.incr(f'{name}_seconds', seconds)
+    if has_request_context() and 'timings' in g:
+        total, count = g.timings.get(name, (0.0, 0))
+        g.timings[name] = (total + seconds, count + calls)
+
+
+@contextmanager
+def timed(name):
+    """Times the body of the `with` block as `name`."""
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        record(name, perf_counter() - start)
+
+
+def init_app(app):
+    """Registers the request hooks and the /metrics endpoint. Runs after
+    db.init_app(), as it listens to the engines' events."""
+    if not app.config['INSTRUMENTATION_ENABLED']:
+        return
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_after_render, app)
+    if app.config['METRICS_ENDPOINT']:
+        app.add_url_rule('/metrics', 'metrics', metrics_view)
+    with app.app_context():
+        for engine in db.engines.values():
+            _instrument_engine(engine, app.config['SLOW_QUERY_THRESHOLD'])
+
+
+def _instrument_engine(engine, slow_threshold):
+    @sa.event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context,
+                              executemany):
+        conn.info.setdefault('query_start', []).append(perf_counter())
+
+    @sa.event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context,
+                             executemany):
+        elapsed = perf_counter() - conn.info['query_start'].pop()
+        record('sql', elapsed)
+        if slow_threshold is not None and elapsed >= slow_threshold:
+            metrics.incr('sql_slow')
+            slow_query_logger.warning(json.dumps({
+                'duration_ms': round(elapsed * 1000, 2),
+                'statement': statement,
+                'path': request.path if has_request_context() else None,
+            }))
+
+    @sa.event.listens_for(engine, 'handle_error')
+    def handle_error(context):
+        # A failed statement never reaches after_cursor_execute
+        if context.connection is not None and \
+                context.connection.info.get('query_start'):
+            context.connection.info['query_start'].pop()
+
+
+def _before_render(sender, template, context, **extra):
+    # Templates render other templates (render_post() in feeds); only the
+    # outermost render is timed so nothing is counted twice
+    depth = g.get('render_depth', 0)
+    if depth == 0:
+        g.render_start = perf_counter()
+    g.render_depth = depth + 1
+
+
+def _after_render(sender, template, context, **extra):
+    g.render_depth -= 1
+    if g.render_depth == 0:
+        record('template', perf_counter() - g.render_start)
+
+
+def _start_request():
+    g.timings = {}
+    g.request_start = perf_counter()
+
+
+def _finish_request(response):
+    if 'request_start' not in g:
+        return response
+    elapsed = perf_counter() - g.request_start
+    metrics.incr('requests')
+    metrics.incr('request_seconds', elapsed)
+    metrics.incr(f'responses_{response.status_code // 100}xx')
+
+    timings = [f'{name};dur={total * 1000:.2f};desc="{count}"'
+               for name, (total, count) in g.timings.items()]
+    timings.append(f'total;dur={elapsed * 1000:.2f}')
+    response.headers.add('Server-Timing', ', '.join(timings))
+
+    config = current_app.config
+    slow = config['SLOW_REQUEST_THRESHOLD'] is not None and \
+        elapsed >= config['SLOW_REQUEST_THRESHOLD']
+    if slow or config['REQUEST_LOG']:
+        line = json.dumps({
+            'method': request.method,
+            'path': request.path,
+            'endpoint': request.endpoint,
+            'status': response.status_code,
+            'duration_ms': round(elapsed * 1000, 2),
+            **{f'{name}_ms': round(total * 1000, 2)
+               for name, (total, _) in g.timings.items()},
+            **{f'{name}_calls': count
+               for name, (_, count) in g.timings.items()},
+        })
+        if slow:
+            metrics.incr('requests_slow')
+            request_logger.warning(line)
+        else:
+            request_logger.info(line)
+    return response
+
+
+def metrics_view():
+    """Serves the counters, the connection pool gauges and the depth of the
+    mail queue in the Prometheus text format."""
+    token = current_app.config['METRICS_TOKEN']
+    if token and not hmac.compare_digest(
+            request.headers.get('Authorization', ''), f'Bearer {token}'):
+        abort(401)
+    lines = []
+    for name, value in sorted(metrics.snapshot().items()):
+        lines.append(f'# TYPE microblog_{name} counter')
+        lines.append(f'microblog_{name} {value}')
+    for name, value in pool_stats().items():
+        if name.startswith('db_pool_'):
+            # Already listed with the counters
+            continue
+        lines.append(f'# TYPE microblog_db_pool_{name} gauge')
+        lines.append(f'microblog_db_pool_{name} {value}')
+    # The dispatcher only exists once a message was sent without the outbox
+    dispatcher = current_app.extensions.get('mail_dispatcher')
+    lines.append('# TYPE microblog_mail_queue_depth gauge')
+    lines.append('microblog_mail_queue_depth '
+                 f'{dispatcher.depth() if dispatcher else 0}')
+    return Response('\n'.join(lines) + '\n',
+                    mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,48 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+from langdetect import DetectorFactory, LangDetectException, detect
+from langdetect.detector_factory import init_factory
+
+from app import db
+from app.models import Post
+from app.pretranslate import enqueue_translations
+
+
+def init_app(app):
+    """Configures langdetect for the app.
+
+    langdetect samples randomly, so a fixed seed makes a post get the same
+    language every time. Its language profiles are loaded on the first
+    detect() call in each process, which otherwise lands on the first user
+    to submit a post."""
+    DetectorFactory.seed = app.config['LANGDETECT_SEED']
+    if app.config['LANGDETECT_PRELOAD']:
+        init_factory()
+
+
+def detect_language(text):
+    """Returns the language code of `text`, or '' if it can't be told."""
+    try:
+        return detect(text)
+    except LangDetectException:
+        return ''
+
+
+def detect_in_background(post):
+    """Detects the language of a committed post on a worker thread and
+    stores it on Post.language. Returns the Future of the task."""
+    app = current_app._get_current_object()
+    executor = app.extensions.get('langdetect_executor')
+    if executor is None:
+        executor = ThreadPoolExecutor(app.config['LANGDETECT_WORKERS'])
+        app.extensions['langdetect_executor'] = executor
+    return executor.submit(_backfill_language, app, post.id)
+
+
+def _backfill_language(app, post_id):
+    with app.app_context():
+        post = db.session.get(Post, post_id)
+        post.language = detect_language(post.body)
+        enqueue_translations(post)
+        db.session.commit()
@@ -1,30 +1,72 @@
-from datetime import datetime, timezone
-
 import sqlalchemy as sa
-from flask import (current_app, flash, g, redirect, render_template, request,
-                   url_for)
+from flask import (abort, current_app, flash, g, redirect, render_template,
+                   request, url_for)
 from flask_babel import get_locale
 from flask_login import current_user, login_required
-from langdetect import LangDetectException, detect
 
-from app import db
+from app import db, metrics
+from app.autocomplete import complete_username
+from app.language import detect_in_background, detect_language
 from app.main import bp
 from app.main.forms import EditProfileForm, EmptyForm, PostForm
 from app.models import Post, User
-from app.translate_service import translate
+from app.page_cache import cached_fragment
+from app.pagination import keyset_paginate
+from app.pretranslate import enqueue_translations
+from app.search import search_posts
+from app.translate_service import (batch_items, stored_translations,
+                                   translate, translate_posts)
 
 
 @bp.before_request
 def before_request():
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.now(timezone.utc)
         # when you reference current_user, Flask-Login will invoke the user
         # loader callback function, which will run a database query that will
         # put the target user in the database session.
-        db.session.commit()
+        # Only commit when last_seen is stale, so most page views are
+        # read-only transactions.
+        if current_user.touch():
+            db.session.commit()
+            metrics.incr('last_seen_writes')
+        else:
+            metrics.incr('last_seen_writes_skipped')
         g.locale = str(get_locale())
 
 
+def paginate_feed(query, endpoint, **values):
+    """Returns one page of a post feed as (posts, next_url, prev_url).
+
+    Feeds are paginated with `?before=`/`?after=` cursors on
+    (Post.time_stamp, Post.id), which never needs a COUNT query. Old
+    `?page=` links are still served through db.paginate(). `query` can be
+    a function, see keyset_paginate()."""
+    per_page = current_app.config['POSTS_PER_PAGE']
+    if 'page' in request.args:
+        if callable(query):
+            query = query()
+        page = request.args.get('page', 1, type=int)
+        posts = db.paginate(query, page=page, per_page=per_page,
+                            error_out=False)
+        # You can add any keyword arguments to <url_for()>, and if the names
+        # of those arguments are not part of the URL that is defined for the
+        # route, then Flask will include them as query arguments.
+        next_url = url_for(endpoint, page=posts.next_num, **values) \
+            if posts.has_next else None
+        prev_url = url_for(endpoint, page=posts.prev_num, **values) \
+            if posts.has_prev else None
+        return posts.items, next_url, prev_url
+
+    posts = keyset_paginate(
+        query, Post.time_stamp, Post.id, per_page,
+        before=request.args.get('before'), after=request.args.get('after'))
+    next_url = url_for(endpoint, before=posts.next_cursor, **values) \
+        if posts.next_cursor else None
+    prev_url = url_for(endpoint, after=posts.prev_cursor, **values) \
+        if posts.prev_cursor else None
+    return posts.items, next_url, prev_url
+
+
 @bp.route('/', methods=['GET', 'POST'])
 @bp.route('/index', methods=['GET', 'POST'])
 @login_required
@@ -32,16 +74,20 @@ def index():
     form = PostForm()
     # if it is a POST request
     if form.validate_on_submit():
-        # Detect post language
-        try:
-            language = detect(form.post.data)
-        except LangDetectException:
-            language = ''
+        # Detect post language, unless it is left to a background thread
+        if current_app.config['LANGDETECT_ASYNC']:
+            language = None
+        else:
+            language = detect_language(form.post.data)
         # Construct the post object
         post = Post(body=form.post.data, author=current_user,
                     language=language)
         db.session.add(post)
+        post.fan_out()
+        enqueue_translations(post)
         db.session.commit()
+        if language is None:
+            detect_in_background(post)
         flash("Your post is sent")
         # It is a standard practice to always respond to a POST request
         # generated by a web form submission with a redirect. This simple
@@ -52,22 +98,9 @@ def index():
     # if it is a GET request
     # You may use the `posts` object with the all() to create a list
     # posts = db.session.scalars(current_user.following_posts())
-    page = request.args.get('page', 1, type=int)
-    posts = db.paginate(
-        current_user.following_posts(), page=page,
-        per_page=current_app.config['POSTS_PER_PAGE'], error_out=False
-    )
-    # You can add any keyword arguments to <url_for()>, and if the names of
-    # those arguments are not part of the URL that is defined for the route,
-    # then Flask will include them as query arguments.
-    if posts.has_next:
-        next_url = url_for('main.index', page=posts.next_num)
-    else:
-        next_url = None
-    # This implementation method is to recall your python skills.
-    prev_url = url_for('main.index', page=posts.prev_num) if posts.has_prev \
-        else None
-    return render_template('index.html', title='Home', posts=posts.items,
+    posts, next_url, prev_url = paginate_feed(
+        current_user.home_timeline, 'main.index')
+    return render_template('index.html', title='Home', posts=posts,
                            form=form, prev_url=prev_url,
                            next_url=next_url)
 
@@ -75,40 +108,64 @@ def index():
 @bp.route('/explore')
 @login_required
 def explore():
-    query = sa.select(Post).order_by(Post.time_stamp.desc())
-    page = request.args.get('page', 1, type=int)
-    posts = db.paginate(
-        query, page=page, per_page=current_app.config['POSTS_PER_PAGE'],
-        error_out=False
-    )
-    next_url = url_for('main.explore', page=posts.next_num) \
-        if posts.has_next else None
-    prev_url = url_for('main.explore', page=posts.prev_num) \
-        if posts.has_prev else None
-    return render_template('index.html', title='Explore', posts=posts.items,
+    # Every user sees the same explore feed, so the list of posts is cached
+    # and only the page around it is rendered per user
+    return render_template('index.html', title='Explore',
+                           feed=explore_feed())
+
+
+@cached_fragment('posts')
+def explore_feed():
+    posts, next_url, prev_url = paginate_feed(Post.feed(), 'main.explore')
+    return render_template('_feed.html', posts=posts, next_url=next_url,
+                           prev_url=prev_url)
+
+
+@bp.route('/search')
+@login_required
+def search():
+    q = request.args.get('q', '').strip()
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = current_app.config['POSTS_PER_PAGE']
+    # Ask for one extra result to find out whether there is a next page
+    ids = search_posts(q, per_page + 1, (page - 1) * per_page) if q else []
+    has_next = len(ids) > per_page
+    ids = ids[:per_page]
+    posts = db.session.scalars(
+        Post.feed(sa.select(Post).where(Post.id.in_(ids)))).all()
+    # Keep the order of the search results
+    posts.sort(key=lambda post: ids.index(post.id))
+    next_url = url_for('main.search', q=q, page=page + 1) \
+        if has_next else None
+    prev_url = url_for('main.search', q=q, page=page - 1) \
+        if page > 1 else None
+    return render_template('index.html', title='Search', posts=posts,
                            next_url=next_url, prev_url=prev_url)
 
 
+@bp.route('/autocomplete/users')
+@login_required
+def autocomplete_users() -> dict:
+    q = request.args.get('q', '').strip()
+    limit = min(request.args.get('limit', current_app.config[
+        'AUTOCOMPLETE_LIMIT'], type=int), 50)
+    users = complete_username(q, limit) if q else []
+    return {'users': [{'username': username, 'followers': followers}
+                      for username, followers in users]}
+
+
 @bp.route('/user/<username>')
 @login_required
 def user(username):
     user = db.first_or_404(sa.select(User).where(
         User.username == username))
-    page = request.args.get('page', 1, type=int)
     # user.posts relationship is defined as a write-only relationship,
     # so the attribute has a select() method.
-    query = user.posts.select().order_by(Post.time_stamp.desc())
-    posts = db.paginate(query, page=page,
-                        per_page=current_app.config['POSTS_PER_PAGE'],
-                        error_out=False)
-    next_url = url_for(
-        'main.user', username=user.username, page=posts.next_num) \
-        if posts.has_next else None
-    prev_url = url_for(
-        'main.user', username=user.username, page=posts.prev_num) \
-        if posts.has_prev else None
+    query = Post.feed(user.posts.select().order_by(Post.time_stamp.desc()))
+    posts, next_url, prev_url = paginate_feed(
+        query, 'main.user', username=user.username)
     form = EmptyForm()
-    return render_template('user.html', user=user, posts=posts.items,
+    return render_template('user.html', user=user, posts=posts,
                            form=form, next_url=next_url, prev_url=prev_url)
 
 
@@ -124,6 +181,7 @@ def edit_profile():
             current_user.username = form.username.data
         if form.about_me.data != '':
             current_user.about_me = form.about_me.data
+        current_user.profile_version += 1
         db.session.commit()
         flash("Your changes are made")
         return redirect(url_for('main.edit_profile'))
@@ -180,5 +238,26 @@ def unfollow(username):
 def translate_text() -> dict:
     data = request.get_json()
     current_app.logger.info(data)
-    return {'text': translate(data['text'], data['source_lang'],
-                              data['dest_lang'])}
+    if data.get('post_id'):
+        # Posts translated in the background are a plain lookup
+        item = (int(data['post_id']), data['dest_lang'])
+        stored = stored_translations([item])
+        if item in stored:
+            return {'text': stored[item]}
+    text = translate(data['text'], data['source_lang'], data['dest_lang'])
+    db.session.commit()
+    return {'text': text}
+
+
+@bp.route('/translate/batch', methods=['POST'])
+@login_required
+def translate_batch() -> dict:
+    """Translates many posts in one request. Expects
+    {"items": [{"post_id": 1, "dest_lang": "en"}, ...]}."""
+    try:
+        items = batch_items(request.get_json(silent=True) or {})
+    except ValueError:
+        abort(400)
+    translations = translate_posts(items)
+    db.session.commit()
+    return {'translations': translations}
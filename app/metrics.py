@@ -0,0 +1,25 @@
+import threading
+from collections import defaultdict
+
+# Process-wide counters, e.g. how many writes a cache has saved. They are
+# reset when the process restarts.
+_lock = threading.Lock()
+_counters = defaultdict(int)
+
+
+def incr(name, value=1):
+    """Adds `value` to the counter called `name`."""
+    with _lock:
+        _counters[name] += value
+
+
+def get(name):
+    """Returns the current value of the counter called `name`."""
+    with _lock:
+        return _counters[name]
+
+
+def snapshot():
+    """Returns a copy of all counters."""
+    with _lock:
+        return dict(_counters)
@@ -1,16 +1,17 @@
 import hashlib
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 from time import time
 from typing import Optional
 
-from flask import current_app
+from flask import current_app, g
 import jwt
 import sqlalchemy as sa
 import sqlalchemy.orm as so
 from flask_login import UserMixin
-from werkzeug.security import check_password_hash, generate_password_hash
 
-from app import db, login
+from app import db
+from app.pagination import keyset_window
+from app.passwords import hash_password, verify_password
 
 followers = sa.Table(
     "followers",
@@ -22,6 +23,22 @@ followers = sa.Table(
               primary_key=True)
 )
 
+# Materialized home timeline. Every post gets one row per reader (its author
+# and the author's followers) when it is written, so reading a home page is a
+# range scan over the (user_id, time_stamp, post_id) index instead of a join
+# through the followers table.
+timeline = sa.Table(
+    "timeline",
+    db.metadata,
+    sa.Column('user_id', sa.Integer, sa.ForeignKey('user.id'),
+              primary_key=True),
+    sa.Column('post_id', sa.Integer, sa.ForeignKey('post.id'),
+              primary_key=True),
+    sa.Column('time_stamp', sa.DateTime, nullable=False),
+    sa.Index('ix_timeline_user_id_time_stamp_post_id', 'user_id',
+             'time_stamp', 'post_id')
+)
+
 
 class User(UserMixin, db.Model):
 
@@ -35,6 +52,9 @@ class User(UserMixin, db.Model):
     email: so.Mapped[str] = so.mapped_column(sa.String(120), index=True,
                                              unique=True)
     password_hash: so.Mapped[Optional[str]] = so.mapped_column(sa.String(256))
+    # Gravatar hash of the email, set whenever the email is, see
+    # _set_email_hash()
+    email_hash: so.Mapped[Optional[str]] = so.mapped_column(sa.String(32))
 
     about_me: so.Mapped[Optional[str]] = so.mapped_column(sa.String(140))
 
@@ -43,6 +63,27 @@ class User(UserMixin, db.Model):
         default=lambda: datetime.now(timezone.utc)
     )
 
+    # Authors with more followers than TIMELINE_FANOUT_LIMIT are not fanned
+    # out on write; their posts are merged into readers' timelines on read.
+    high_fanout: so.Mapped[bool] = so.mapped_column(
+        default=False, server_default=sa.false()
+    )
+
+    # Denormalized sizes of the followers/followings relationships, kept up
+    # to date by follow() and unfollow() in the same transaction.
+    num_followers: so.Mapped[int] = so.mapped_column(
+        default=0, server_default='0'
+    )
+    num_following: so.Mapped[int] = so.mapped_column(
+        default=0, server_default='0'
+    )
+
+    # Bumped on every profile edit, so caches of anything showing the
+    # profile can tell their copy is stale
+    profile_version: so.Mapped[int] = so.mapped_column(
+        default=0, server_default='0'
+    )
+
     posts: so.WriteOnlyMapped['Post'] = so.relationship(
         back_populates='author'
     )
@@ -66,45 +107,157 @@ class User(UserMixin, db.Model):
 
         return f"<User {self.username}>"
 
+    def get_id(self):
+        # The session remembers which version of the profile it last saw,
+        # see identity.load_user()
+        return f'{self.id}:{self.profile_version}'
+
+    def touch(self):
+        """Sets last_seen to now, unless it was already updated less than
+        LAST_SEEN_UPDATE_INTERVAL seconds ago. Returns True if the value
+        changed and needs to be committed."""
+        now = datetime.now(timezone.utc)
+        last_seen = self.last_seen
+        if last_seen is not None:
+            if last_seen.tzinfo is None:
+                # SQLite hands back naive datetimes, which are stored in UTC
+                last_seen = last_seen.replace(tzinfo=timezone.utc)
+            interval = current_app.config['LAST_SEEN_UPDATE_INTERVAL']
+            if now - last_seen < timedelta(seconds=interval):
+                return False
+        self.last_seen = now
+        return True
+
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = hash_password(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return verify_password(self.password_hash, password)
+
+    @staticmethod
+    def hash_email(email):
+        return hashlib.md5(email.lower().strip().encode()).hexdigest()
+
+    @so.validates('email')
+    def _set_email_hash(self, key, email):
+        self.email_hash = self.hash_email(email)
+        return email
 
     def avatar(self, size):
-        email_hash = hashlib.md5(
-            self.email.lower().strip().encode()
-        ).hexdigest()
-        avatar_url = (
-            f"https://www.gravatar.com/avatar/{email_hash}?s={size}&d=mp")
-        return avatar_url
+        return (f"https://www.gravatar.com/avatar/{self.email_hash}"
+                f"?s={size}&d=mp")
+
+    @staticmethod
+    def avatars(users, size):
+        """Returns the avatar URLs of `users` at `size`, in the same
+        order."""
+        query = f'?s={size}&d=mp'
+        return [f'https://www.gravatar.com/avatar/{user.email_hash}{query}'
+                for user in users]
 
     def follow(self, user):
         if not self.is_following(user):
             self.followings.add(user)
+            # Increment in SQL so concurrent follows don't lose updates, and
+            # flush right away: another follow before the next flush would
+            # replace the expressions and lose this increment
+            self.num_following = User.num_following + 1
+            user.num_followers = User.num_followers + 1
+            db.session.flush()
+            self._timeline_add_author(user)
+            self._following_cache()[user.id] = True
 
     def unfollow(self, user):
         if self.is_following(user):
             self.followings.remove(user)
+            self.num_following = User.num_following - 1
+            user.num_followers = User.num_followers - 1
+            db.session.flush()
+            self._timeline_remove_author(user)
+            self._following_cache()[user.id] = False
+
+    def _timeline_add_author(self, user):
+        """Copy the existing posts of `user` into this user's timeline."""
+        if user.high_fanout:
+            # These posts are merged in on read, see home_timeline().
+            return
+        db.session.flush()
+        db.session.execute(
+            sa.insert(timeline).from_select(
+                ['user_id', 'post_id', 'time_stamp'],
+                sa.select(sa.literal(self.id), Post.id, Post.time_stamp)
+                .where(Post.user_id == user.id)
+            )
+        )
+
+    def _timeline_remove_author(self, user):
+        """Drop the posts of `user` from this user's timeline."""
+        db.session.execute(
+            sa.delete(timeline).where(
+                timeline.c.user_id == self.id,
+                timeline.c.post_id.in_(
+                    sa.select(Post.id).where(Post.user_id == user.id)
+                )
+            )
+        )
 
     def is_following(self, user):
-        # All write-only relationships have a select() method that constructs
-        # a query that returns all the elements in the relationship.
-        q = self.followings.select().where(User.id == user.id)
-        return db.session.scalar(q) is not None
+        return user.id in self.following_among([user])
+
+    def following_among(self, users):
+        """Returns the ids of the given users (User objects or ids) that this
+        user follows.
+
+        All users that weren't asked about earlier in the request are looked
+        up with a single `IN` query, so pages that show follow buttons for a
+        list of users cost one query instead of one per user."""
+        ids = {u if isinstance(u, int) else u.id for u in users}
+        ids.discard(None)
+        cache = self._following_cache()
+        missing = ids - cache.keys()
+        if missing:
+            q = sa.select(followers.c.followed_id).where(
+                followers.c.follower_id == self.id,
+                followers.c.followed_id.in_(missing)
+            )
+            found = set(db.session.scalars(q))
+            for id in missing:
+                cache[id] = id in found
+        return {id for id in ids if cache[id]}
+
+    def _following_cache(self):
+        """Request-scoped memo of {user id: is followed by self}."""
+        return g.setdefault('following_cache', {}).setdefault(self.id, {})
 
     def followers_count(self):
-        q = sa.select(sa.func.count()).select_from(
-            self.followers.select().subquery()
-        )
-        return db.session.scalar(q)
+        return self.num_followers
 
     def following_count(self):
-        q = sa.select(sa.func.count()).select_from(
-            self.followings.select().subquery()
+        return self.num_following
+
+    @staticmethod
+    def reconcile_follow_counts():
+        """Recomputes num_followers and num_following from the followers
+        table for every user whose counters have drifted. Returns the number
+        of users that were repaired."""
+        n_followers = (
+            sa.select(sa.func.count())
+            .where(followers.c.followed_id == User.id)
+            .scalar_subquery()
+        )
+        n_following = (
+            sa.select(sa.func.count())
+            .where(followers.c.follower_id == User.id)
+            .scalar_subquery()
         )
-        return db.session.scalar(q)
+        result = db.session.execute(
+            sa.update(User)
+            .where(sa.or_(User.num_followers != n_followers,
+                          User.num_following != n_following))
+            .values(num_followers=n_followers, num_following=n_following)
+            .execution_options(synchronize_session=False)
+        )
+        return result.rowcount
 
     def get_reset_password_token(self, expires_in=600):
         return jwt.encode(
@@ -135,7 +288,7 @@ class User(UserMixin, db.Model):
         Author = so.aliased(User)
         Follower = so.aliased(User)
 
-        return (
+        return Post.feed(
             # Start building the SQLAlchemy query by selecting all `Post`
             # entries.
             sa.select(Post)
@@ -172,9 +325,69 @@ class User(UserMixin, db.Model):
             .order_by(Post.time_stamp.desc())
         )
 
+    def home_timeline(self, limit=None, before=None, after=None):
+        """Returns the same posts as following_posts(), read from the
+        materialized `timeline` table.
+
+        Posts of high-fanout authors are not copied into the table, so they
+        are pulled from the authors this user follows and merged in. With a
+        `limit`, and optionally a `before` or `after` (time_stamp, id) key,
+        each side is cut to one page before they are merged, so a page
+        never reads more than 2 * `limit` rows; see keyset_paginate()."""
+        pushed = keyset_window(
+            sa.select(timeline.c.post_id, timeline.c.time_stamp)
+            .where(timeline.c.user_id == self.id),
+            timeline.c.time_stamp, timeline.c.post_id, limit, before, after
+        ).subquery()
+        pulled = keyset_window(
+            sa.select(Post.id.label('post_id'), Post.time_stamp)
+            .join(followers, followers.c.followed_id == Post.user_id)
+            .join(User, User.id == Post.user_id)
+            .where(followers.c.follower_id == self.id, User.high_fanout),
+            Post.time_stamp, Post.id, limit, before, after
+        ).subquery()
+        # UNION (not UNION ALL) drops posts that were fanned out before their
+        # author crossed the fan-out limit.
+        feed = sa.union(sa.select(pushed), sa.select(pulled)).subquery()
+        return Post.feed(
+            sa.select(Post)
+            .join(feed, feed.c.post_id == Post.id)
+            .order_by(Post.time_stamp.desc(), Post.id.desc())
+        )
+
+    @staticmethod
+    def rebuild_timelines():
+        """Rebuilds the whole `timeline` table from the followers graph."""
+        db.session.execute(sa.delete(timeline))
+        own = sa.select(Post.user_id, Post.id, Post.time_stamp)
+        followed = (
+            sa.select(followers.c.follower_id, Post.id, Post.time_stamp)
+            .join(Post, Post.user_id == followers.c.followed_id)
+            .join(User, User.id == Post.user_id)
+            .where(sa.not_(User.high_fanout))
+        )
+        db.session.execute(
+            sa.insert(timeline).from_select(
+                ['user_id', 'post_id', 'time_stamp'],
+                sa.union(own, followed)
+            )
+        )
+
 
 class Post(db.Model):
     __tablename__ = 'post'
+    # Composite indexes backing keyset pagination of the explore and user
+    # feeds on (time_stamp, id).
+    __table_args__ = (
+        sa.Index('ix_post_time_stamp_id', 'time_stamp', 'id'),
+        sa.Index('ix_post_user_id_time_stamp_id', 'user_id', 'time_stamp',
+                 'id'),
+        # Full-text index used by app.search on Postgres
+        sa.Index('ix_post_body_tsvector',
+                 sa.func.to_tsvector(sa.literal_column("'simple'"),
+                                     sa.literal_column('body')),
+                 postgresql_using='gin').ddl_if(dialect='postgresql'),
+    )
     id: so.Mapped[int] = so.mapped_column(primary_key=True)
     body: so.Mapped[str] = so.mapped_column(sa.String(140))
     time_stamp: so.Mapped[datetime] = so.mapped_column(
@@ -192,9 +405,137 @@ class Post(db.Model):
     def __repr__(self):
         return f"<Post {self.body}"
 
+    @staticmethod
+    def feed(query=None):
+        """Prepares a post query for rendering as a feed.
+
+        _post.html reads `post.author` for every post, so the authors of the
+        selected posts are loaded with one extra `IN` query instead of one
+        lazy load per post. Without a query, returns all posts newest
+        first."""
+        if query is None:
+            query = sa.select(Post).order_by(Post.time_stamp.desc())
+        return query.options(so.selectinload(Post.author))
+
+    def fan_out(self):
+        """Writes this post into the timelines of its author and the
+        author's followers."""
+        author = self.author
+        db.session.flush()
+        if not author.high_fanout and (
+                author.followers_count()
+                > current_app.config['TIMELINE_FANOUT_LIMIT']):
+            author.high_fanout = True
+        rows = sa.select(
+            sa.literal(author.id), sa.literal(self.id),
+            sa.literal(self.time_stamp, type_=sa.DateTime)
+        )
+        if not author.high_fanout:
+            rows = sa.union(rows, sa.select(
+                followers.c.follower_id, sa.literal(self.id),
+                sa.literal(self.time_stamp, type_=sa.DateTime)
+            ).where(followers.c.followed_id == author.id))
+        db.session.execute(
+            sa.insert(timeline).from_select(
+                ['user_id', 'post_id', 'time_stamp'], rows)
+        )
+
+
+class CachedTranslation(db.Model):
+    """A translation returned by the translator backend, keyed on a hash of
+    the source text and the language pair."""
+    __tablename__ = 'translation_cache'
+    text_hash: so.Mapped[str] = so.mapped_column(sa.String(64),
+                                                 primary_key=True)
+    source_lang: so.Mapped[str] = so.mapped_column(sa.String(5),
+                                                   primary_key=True)
+    dest_lang: so.Mapped[str] = so.mapped_column(sa.String(5),
+                                                 primary_key=True)
+    translation: so.Mapped[str] = so.mapped_column(sa.Text)
+    created_at: so.Mapped[datetime] = so.mapped_column(
+        index=True, default=lambda: datetime.now(timezone.utc)
+    )
+
+    def __repr__(self):
+        return f"<CachedTranslation {self.source_lang}->{self.dest_lang}>"
+
+    def is_expired(self, now, ttl):
+        created_at = self.created_at
+        if created_at.tzinfo is None:
+            created_at = created_at.replace(tzinfo=timezone.utc)
+        return now - created_at > ttl
+
+
+class PostTranslation(db.Model):
+    """A post translated ahead of time by the pre-translation worker."""
+    __tablename__ = 'post_translation'
+    post_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(Post.id),
+                                               primary_key=True)
+    language: so.Mapped[str] = so.mapped_column(sa.String(5),
+                                                primary_key=True)
+    body: so.Mapped[str] = so.mapped_column(sa.Text)
+
+    def __repr__(self):
+        return f"<PostTranslation {self.post_id} {self.language}>"
+
+
+class TranslationJob(db.Model):
+    """Durable queue entry asking the pre-translation worker to translate a
+    post into one language."""
+    __tablename__ = 'translation_job'
+    id: so.Mapped[int] = so.mapped_column(primary_key=True)
+    post_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(Post.id),
+                                               index=True)
+    post: so.Mapped[Post] = so.relationship()
+    dest_lang: so.Mapped[str] = so.mapped_column(sa.String(5))
+    # 'pending' until translated ('done') or out of attempts ('failed')
+    status: so.Mapped[str] = so.mapped_column(sa.String(10),
+                                              default='pending')
+    attempts: so.Mapped[int] = so.mapped_column(default=0)
+    # A job is picked up once this is in the past. Claiming a job pushes it
+    # forward by a lease, failing pushes it forward by the retry backoff.
+    next_attempt_at: so.Mapped[datetime] = so.mapped_column(
+        default=lambda: datetime.now(timezone.utc)
+    )
+    last_error: so.Mapped[Optional[str]] = so.mapped_column(sa.String(256))
+
+    __table_args__ = (
+        sa.Index('ix_translation_job_status_next_attempt_at', 'status',
+                 'next_attempt_at'),
+    )
+
+    def __repr__(self):
+        return f"<TranslationJob {self.post_id} {self.dest_lang}>"
+
+
+class Outbox(db.Model):
+    """An email waiting to be sent. Rows are written in the transaction
+    that produced the email and sent later by `flask outbox work`."""
+    __tablename__ = 'outbox'
+    id: so.Mapped[int] = so.mapped_column(primary_key=True)
+    subject: so.Mapped[str] = so.mapped_column(sa.String(256))
+    sender: so.Mapped[str] = so.mapped_column(sa.String(120))
+    recipients: so.Mapped[list] = so.mapped_column(sa.JSON)
+    text_body: so.Mapped[str] = so.mapped_column(sa.Text)
+    html_body: so.Mapped[str] = so.mapped_column(sa.Text)
+    # 'pending' until sent ('sent') or out of attempts ('failed')
+    status: so.Mapped[str] = so.mapped_column(sa.String(10),
+                                              default='pending')
+    attempts: so.Mapped[int] = so.mapped_column(default=0)
+    # A worker owns a row until leased_until; a failed row is not retried
+    # before leased_until either.
+    leased_until: so.Mapped[Optional[datetime]] = so.mapped_column()
+    lease_token: so.Mapped[Optional[str]] = so.mapped_column(
+        sa.String(32), index=True)
+    created_at: so.Mapped[datetime] = so.mapped_column(
+        default=lambda: datetime.now(timezone.utc)
+    )
+    sent_at: so.Mapped[Optional[datetime]] = so.mapped_column()
+
+    __table_args__ = (
+        sa.Index('ix_outbox_status_leased_until', 'status', 'leased_until'),
+    )
+
+    def __repr__(self):
+        return f"<Outbox {self.subject}>"
 
-# When you reference current_user, Flask-Login will invoke the user loader
-# callback function
-@login.user_loader
-def load_user(id):
-    return db.session.get(User, int(id))
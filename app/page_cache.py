@@ -0,0 +1,150 @@
+import threading
+from functools import wraps
+
+import sqlalchemy as sa
+from flask import current_app, g, render_template, request
+from markupsafe import Markup
+
+from app import metrics
+from app.cache import LRUCache
+from app.commit_hooks import subscribe
+from app.models import Post, User
+
+
+class MemoryStore:
+    """Page cache store living in the process."""
+
+    def __init__(self, maxsize, ttl):
+        self.pages = LRUCache(maxsize, ttl=ttl)
+        self.tags = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        return self.pages.get(key)
+
+    def set(self, key, value):
+        self.pages.set(key, value)
+
+    def versions(self, tags):
+        with self._lock:
+            return [self.tags.get(tag, 0) for tag in tags]
+
+    def bump(self, tag):
+        with self._lock:
+            self.tags[tag] = self.tags.get(tag, 0) + 1
+
+
+class RedisStore:
+    """Page cache store shared by all processes through Redis."""
+
+    def __init__(self, url, ttl):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+
+    def get(self, key):
+        value = self.client.get(key)
+        return None if value is None else value.decode()
+
+    def set(self, key, value):
+        self.client.set(key, value, ex=self.ttl)
+
+    def versions(self, tags):
+        return [int(v or 0) for v in
+                self.client.mget([f'page-tag:{tag}' for tag in tags])]
+
+    def bump(self, tag):
+        self.client.incr(f'page-tag:{tag}')
+
+
+def get_store():
+    """Returns the page cache store of the current app, as chosen by
+    PAGE_CACHE_BACKEND."""
+    store = current_app.extensions.get('page_cache')
+    if store is None:
+        config = current_app.config
+        if config['PAGE_CACHE_BACKEND'] == 'redis':
+            store = RedisStore(config['PAGE_CACHE_REDIS_URL'],
+                               config['PAGE_CACHE_TTL'])
+        else:
+            store = MemoryStore(config['PAGE_CACHE_SIZE'],
+                                config['PAGE_CACHE_TTL'])
+        current_app.extensions['page_cache'] = store
+    return store
+
+
+def cached_fragment(*tags):
+    """Caches the HTML returned by a fragment-rendering view helper.
+
+    The cache key is the function name, the full request path and the
+    locale, plus the current version of each tag; invalidate(tag) bumps the
+    version so older entries are never read again and age out. The wrapped
+    function must not render anything that depends on the user, like
+    current_user or CSRF tokens; leave those in the page around it."""
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if not current_app.config['PAGE_CACHE_ENABLED']:
+                return Markup(f(*args, **kwargs))
+            store = get_store()
+            versions = '.'.join(str(v) for v in store.versions(tags))
+            key = (f'page:{f.__name__}:{versions}:{g.get("locale", "")}:'
+                   f'{request.full_path}')
+            html = store.get(key)
+            if html is None:
+                metrics.incr('page_cache_misses')
+                html = f(*args, **kwargs)
+                store.set(key, html)
+            else:
+                metrics.incr('page_cache_hits')
+            return Markup(html)
+        return wrapper
+    return decorator
+
+
+def render_post(post):
+    """Renders _post.html for `post`, through a bounded LRU of rendered
+    posts.
+
+    Posts don't change once written, so the HTML only depends on the post,
+    its language (filled in later when detected in the background), the
+    author's profile_version, bumped on every profile edit, and the
+    reader's locale."""
+    cache = current_app.extensions.get('post_fragments')
+    if cache is None:
+        cache = LRUCache(current_app.config['POST_FRAGMENT_CACHE_SIZE'])
+        current_app.extensions['post_fragments'] = cache
+    key = (post.id, post.language, post.author.profile_version,
+           g.get('locale', ''))
+    html = cache.get(key)
+    if html is None:
+        metrics.incr('post_fragment_misses')
+        html = render_template('_post.html', post=post)
+        cache.set(key, html)
+    else:
+        metrics.incr('post_fragment_hits')
+    return Markup(html)
+
+
+def invalidate(tag):
+    get_store().bump(tag)
+
+
+# Feeds of posts are invalidated whenever a transaction adds a post or
+# renames a user, since feeds show their authors' names.
+
+def _collect(session, regions):
+    if any(isinstance(obj, Post) for obj in session.new) or any(
+            isinstance(obj, User)
+            and sa.inspect(obj).attrs.username.history.has_changes()
+            for obj in session.dirty):
+        regions.add('posts')
+
+
+def _apply(regions):
+    if current_app.config['PAGE_CACHE_ENABLED']:
+        for region in regions:
+            invalidate(region)
+
+
+subscribe('page_cache_regions', set, _collect, _apply)
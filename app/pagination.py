@@ -0,0 +1,95 @@
+import base64
+from datetime import datetime
+
+import sqlalchemy as sa
+
+from app import db
+
+
+def encode_cursor(time_stamp, id):
+    """Packs a (time_stamp, id) sort key into an opaque URL-safe string."""
+    raw = f"{time_stamp.isoformat()}|{id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Unpacks a cursor made by encode_cursor(). Returns None if the cursor
+    is missing or malformed."""
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        time_stamp, id = raw.decode().split('|')
+        return datetime.fromisoformat(time_stamp), int(id)
+    except ValueError:
+        return None
+
+
+class KeysetPage:
+    """One page of a newest-first feed, addressed by cursors instead of page
+    numbers. Unlike db.paginate() it never runs a COUNT query."""
+
+    def __init__(self, items, has_next, has_prev):
+        self.items = items
+        self.has_next = has_next
+        self.has_prev = has_prev
+
+    @property
+    def next_cursor(self):
+        """Cursor for the page of older items (`?before=`)."""
+        if not self.has_next or not self.items:
+            return None
+        return encode_cursor(self.items[-1].time_stamp, self.items[-1].id)
+
+    @property
+    def prev_cursor(self):
+        """Cursor for the page of newer items (`?after=`)."""
+        if not self.has_prev or not self.items:
+            return None
+        return encode_cursor(self.items[0].time_stamp, self.items[0].id)
+
+
+def keyset_window(query, time_col, id_col, limit=None, before=None,
+                  after=None):
+    """Restricts `query` to the rows past the `before` or `after`
+    (time_stamp, id) key, ordered in the direction of travel: newest first,
+    or oldest first when walking towards newer rows with `after`. At most
+    `limit` rows are returned."""
+    key = sa.tuple_(time_col, id_col)
+    if after is not None:
+        query = (query.where(key > sa.tuple_(*after))
+                 .order_by(time_col.asc(), id_col.asc()))
+    else:
+        if before is not None:
+            query = query.where(key < sa.tuple_(*before))
+        query = query.order_by(time_col.desc(), id_col.desc())
+    if limit is not None:
+        query = query.limit(limit)
+    return query
+
+
+def keyset_paginate(query, time_col, id_col, per_page, before=None,
+                    after=None):
+    """Returns a KeysetPage of `query` ordered by (time_col, id_col)
+    descending.
+
+    `before` and `after` are cursors; at most one of them is used. One extra
+    row is fetched to find out whether another page exists in the direction
+    of travel. `query` can also be a function taking `limit`, `before` and
+    `after` keys, for queries that apply the cursor in their subqueries,
+    like User.home_timeline()."""
+    after_key = decode_cursor(after)
+    before_key = decode_cursor(before) if after_key is None else None
+    if callable(query):
+        query = query(limit=per_page + 1, before=before_key, after=after_key)
+
+    query = keyset_window(query.order_by(None), time_col, id_col,
+                          per_page + 1, before_key, after_key)
+    items = db.session.scalars(query).all()
+    more = len(items) > per_page
+    items = items[:per_page]
+
+    if after_key is not None:
+        items.reverse()
+        return KeysetPage(items, has_next=True, has_prev=more)
+    return KeysetPage(items, has_next=more, has_prev=before_key is not None)
@@ -0,0 +1,90 @@
+"""Password hashing on a process pool.
+
+scrypt and pbkdf2 are slow on purpose. Hashes are computed by a pool of
+PASSWORD_HASH_WORKERS processes shared by the whole process, so their CPU
+time doesn't hold the GIL while the worker's other threads serve requests.
+At most PASSWORD_HASH_QUEUE_SIZE hashes are in the pool at once. A request
+that can't get in within PASSWORD_HASH_QUEUE_TIMEOUT seconds gets a 503
+instead of queueing forever. With PASSWORD_HASH_WORKERS = 0, hashes are
+computed in the calling thread.
+"""
+import atexit
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+from flask import current_app
+from werkzeug.exceptions import ServiceUnavailable
+from werkzeug.security import check_password_hash, generate_password_hash
+
+from app import metrics
+from app.instrumentation import timed
+
+
+class PasswordHasherBusy(ServiceUnavailable):
+    description = ('Too many passwords are being checked right now. Please '
+                   'try again in a moment.')
+
+
+_lock = threading.Lock()
+_pool = None
+_slots = None
+
+
+def _get_pool():
+    global _pool, _slots
+    with _lock:
+        if _pool is None:
+            config = current_app.config
+            # Forking a multithreaded web worker can copy a lock held by
+            # another thread into the children and deadlock them, so they
+            # are started from a clean process instead
+            method = 'forkserver' if 'forkserver' in \
+                multiprocessing.get_all_start_methods() else 'spawn'
+            _pool = ProcessPoolExecutor(
+                config['PASSWORD_HASH_WORKERS'],
+                mp_context=multiprocessing.get_context(method))
+            _slots = threading.BoundedSemaphore(
+                config['PASSWORD_HASH_QUEUE_SIZE'])
+            atexit.register(_pool.shutdown)
+    return _pool, _slots
+
+
+def _run(function, *args):
+    config = current_app.config
+    with timed('password_hash'):
+        if not config['PASSWORD_HASH_WORKERS']:
+            return function(*args)
+        pool, slots = _get_pool()
+        if not slots.acquire(timeout=config['PASSWORD_HASH_QUEUE_TIMEOUT']):
+            metrics.incr('password_hash_rejected')
+            raise PasswordHasherBusy()
+        try:
+            return pool.submit(function, *args).result()
+        finally:
+            slots.release()
+
+
+def hash_password(password):
+    """Hashes `password` with PASSWORD_HASH_METHOD."""
+    return _run(generate_password_hash, password,
+                current_app.config['PASSWORD_HASH_METHOD'])
+
+
+def verify_password(password_hash, password):
+    return _run(check_password_hash, password_hash, password)
+
+
+@lru_cache
+def _method_prefix(method):
+    # werkzeug fills in the default parameters, so 'scrypt' is stored as
+    # 'scrypt:32768:8:1'
+    return generate_password_hash('', method).split('$', 1)[0]
+
+
+def needs_rehash(password_hash):
+    """Tells whether `password_hash` was made with other parameters than
+    PASSWORD_HASH_METHOD."""
+    return password_hash.split('$', 1)[0] != _method_prefix(
+        current_app.config['PASSWORD_HASH_METHOD'])
@@ -0,0 +1,168 @@
+"""Background translation of new posts.
+
+When PRETRANSLATE_POSTS is on, main.index queues one TranslationJob per
+configured language that differs from the language of a new post. A worker
+started with `flask pretranslate work` (or `drain`) translates the queued
+posts into the post_translation table, so showing a translation becomes a
+lookup instead of a round-trip to the translator backend.
+"""
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from time import sleep
+
+import sqlalchemy as sa
+import sqlalchemy.orm as so
+from flask import current_app
+
+from app import db, metrics
+from app.models import Post, PostTranslation, TranslationJob
+from app.translate_service import translate_many
+
+
+def enqueue_translations(post):
+    """Queues translations of `post` into every configured language other
+    than its own. The jobs are committed together with the post."""
+    if not current_app.config['PRETRANSLATE_POSTS'] or not post.language:
+        return
+    for language in current_app.config['LANGUAGES']:
+        if language != post.language:
+            db.session.add(TranslationJob(post=post, dest_lang=language))
+
+
+def claim_jobs(limit):
+    """Returns the ids of up to `limit` due jobs and leases them, so that
+    other polls skip them while they are being worked on.
+
+    As in email.claim_outbox(), Postgres locks the due rows with SELECT ...
+    FOR UPDATE SKIP LOCKED so concurrent workers claim disjoint batches;
+    elsewhere a single UPDATE ... WHERE id IN (...) claims them. RETURNING
+    tells which rows this call leased."""
+    now = datetime.now(timezone.utc)
+    lease = timedelta(seconds=current_app.config['PRETRANSLATE_LEASE'])
+    due = (
+        sa.select(TranslationJob.id)
+        .where(TranslationJob.status == 'pending',
+               TranslationJob.next_attempt_at <= now)
+        .order_by(TranslationJob.next_attempt_at)
+        .limit(limit)
+    )
+    if db.engine.dialect.name == 'postgresql':
+        due = db.session.scalars(due.with_for_update(skip_locked=True)).all()
+    else:
+        due = due.scalar_subquery()
+    ids = db.session.scalars(
+        sa.update(TranslationJob)
+        .where(TranslationJob.id.in_(due))
+        .values(next_attempt_at=now + lease)
+        .returning(TranslationJob.id)
+    ).all()
+    db.session.commit()
+    return ids
+
+
+def _run_jobs(app, job_ids):
+    """Translates one group of jobs sharing a language pair."""
+    with app.app_context():
+        jobs = db.session.scalars(
+            sa.select(TranslationJob)
+            .where(TranslationJob.id.in_(job_ids))
+            .options(so.joinedload(TranslationJob.post))
+        ).all()
+        source_lang, dest_lang = jobs[0].post.language, jobs[0].dest_lang
+        try:
+            texts = translate_many([job.post.body for job in jobs],
+                                   source_lang, dest_lang)
+        except Exception as e:
+            db.session.rollback()
+            _retry_later(jobs, e)
+            return
+        for job, text in zip(jobs, texts):
+            db.session.merge(PostTranslation(
+                post_id=job.post_id, language=dest_lang, body=text))
+            job.status = 'done'
+            job.attempts += 1
+        db.session.commit()
+        metrics.incr('pretranslate_jobs_done', len(jobs))
+
+
+def _retry_later(jobs, error):
+    """Schedules failed jobs again with exponential backoff, or gives up on
+    them after PRETRANSLATE_MAX_ATTEMPTS."""
+    config = current_app.config
+    now = datetime.now(timezone.utc)
+    for job in jobs:
+        job.attempts += 1
+        job.last_error = str(error)[:256]
+        if job.attempts >= config['PRETRANSLATE_MAX_ATTEMPTS']:
+            job.status = 'failed'
+            metrics.incr('pretranslate_jobs_failed')
+        else:
+            delay = config['PRETRANSLATE_RETRY_DELAY'] * 2 ** (job.attempts
+                                                              - 1)
+            job.next_attempt_at = now + timedelta(seconds=delay)
+            metrics.incr('pretranslate_jobs_retried')
+    db.session.commit()
+    current_app.logger.warning(
+        'Pre-translation of %d posts failed: %s', len(jobs), error)
+
+
+def process_jobs(limit=None):
+    """Claims one batch of due jobs and translates them on a bounded thread
+    pool, one task per language pair. Returns the number of claimed jobs."""
+    config = current_app.config
+    job_ids = claim_jobs(limit or config['PRETRANSLATE_BATCH_SIZE'])
+    if not job_ids:
+        return 0
+
+    groups = defaultdict(list)
+    rows = db.session.execute(
+        sa.select(TranslationJob.id, Post.language, TranslationJob.dest_lang)
+        .join(Post, Post.id == TranslationJob.post_id)
+        .where(TranslationJob.id.in_(job_ids))
+    )
+    for job_id, source_lang, dest_lang in rows:
+        groups[(source_lang, dest_lang)].append(job_id)
+    db.session.commit()
+
+    app = current_app._get_current_object()
+    with ThreadPoolExecutor(config['PRETRANSLATE_WORKERS']) as executor:
+        futures = [executor.submit(_run_jobs, app, ids)
+                   for ids in groups.values()]
+    for future in futures:
+        # Translator errors are retried in _run_jobs(), anything else is a
+        # bug and should stop the worker
+        future.result()
+    return len(job_ids)
+
+
+def drain():
+    """Processes due jobs until none are left. Returns how many were
+    processed."""
+    total = 0
+    while True:
+        count = process_jobs()
+        if not count:
+            return total
+        total += count
+
+
+def work(poll_interval):
+    """Processes jobs forever, sleeping when the queue is empty."""
+    while True:
+        if not process_jobs():
+            sleep(poll_interval)
+
+
+def replay_failed():
+    """Puts failed jobs back in the queue. Returns how many were
+    requeued."""
+    result = db.session.execute(
+        sa.update(TranslationJob)
+        .where(TranslationJob.status == 'failed')
+        .values(status='pending', attempts=0, last_error=None,
+                next_attempt_at=datetime.now(timezone.utc))
+    )
+    db.session.commit()
+    return result.rowcount
+
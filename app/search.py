@@ -0,0 +1,251 @@
+import re
+import threading
+from collections import defaultdict
+
+import sqlalchemy as sa
+from flask import current_app
+
+from app import db
+from app.commit_hooks import subscribe
+from app.models import Post
+
+
+def _terms(text):
+    return re.findall(r'\w+', text.lower())
+
+
+class SQLiteSearch:
+    """Full-text search with an SQLite FTS5 table, `post_fts`, holding a copy
+    of each post body under the post's id. It is written in the same
+    transaction as the posts."""
+    transactional = True
+
+    def create(self, connection):
+        connection.execute(sa.text(
+            'CREATE VIRTUAL TABLE IF NOT EXISTS post_fts USING fts5(body)'))
+
+    def add(self, connection, posts):
+        if not posts:
+            return
+        self.remove(connection, posts.keys())
+        connection.execute(
+            sa.text('INSERT INTO post_fts (rowid, body) VALUES (:id, :body)'),
+            [{'id': id, 'body': body} for id, body in posts.items()]
+        )
+
+    def remove(self, connection, ids):
+        if ids:
+            connection.execute(
+                sa.text('DELETE FROM post_fts WHERE rowid = :id'),
+                [{'id': id} for id in ids]
+            )
+
+    def clear(self, connection):
+        connection.execute(sa.text('DELETE FROM post_fts'))
+
+    def search(self, text, limit, offset=0):
+        terms = _terms(text)
+        if not terms:
+            return []
+        # Quote every term so user input can't use the FTS query syntax
+        match = ' '.join('"' + term.replace('"', '""') + '"'
+                         for term in terms)
+        return db.session.scalars(
+            sa.text('SELECT rowid FROM post_fts WHERE post_fts MATCH :match '
+                    'ORDER BY rank LIMIT :limit OFFSET :offset'),
+            {'match': match, 'limit': limit, 'offset': offset}
+        ).all()
+
+
+class PostgresSearch:
+    """Full-text search on Postgres with a GIN index over
+    to_tsvector(post.body). Postgres keeps the index current by itself, so
+    there is nothing to do when posts change."""
+    transactional = True
+
+    @staticmethod
+    def _vector():
+        return sa.func.to_tsvector('simple', Post.body)
+
+    def create(self, connection):
+        pass
+
+    def add(self, connection, posts):
+        pass
+
+    def remove(self, connection, ids):
+        pass
+
+    def clear(self, connection):
+        pass
+
+    def search(self, text, limit, offset=0):
+        query = sa.func.plainto_tsquery('simple', text)
+        return db.session.scalars(
+            sa.select(Post.id)
+            .where(self._vector().bool_op('@@')(query))
+            .order_by(sa.func.ts_rank(self._vector(), query).desc(),
+                      Post.id.desc())
+            .limit(limit).offset(offset)
+        ).all()
+
+
+class MemorySearch:
+    """Pure-Python inverted index, for tests. It lives in the process, so it
+    is only updated once a transaction commits."""
+    transactional = False
+
+    def __init__(self):
+        self.postings = defaultdict(set)
+        self.documents = {}
+        self._lock = threading.Lock()
+
+    def create(self, connection):
+        pass
+
+    def add(self, connection, posts):
+        with self._lock:
+            for id, body in posts.items():
+                self._remove(id)
+                self.documents[id] = _terms(body)
+                for term in self.documents[id]:
+                    self.postings[term].add(id)
+
+    def remove(self, connection, ids):
+        with self._lock:
+            for id in ids:
+                self._remove(id)
+
+    def _remove(self, id):
+        for term in self.documents.pop(id, ()):
+            self.postings[term].discard(id)
+
+    def clear(self, connection):
+        with self._lock:
+            self.postings.clear()
+            self.documents.clear()
+
+    def search(self, text, limit, offset=0):
+        terms = set(_terms(text))
+        if not terms:
+            return []
+        with self._lock:
+            ids = set.intersection(*(self.postings.get(term, set())
+                                     for term in terms))
+            # Rank by how often the terms appear, newest first on ties
+            ranked = sorted(
+                ids, key=lambda id: (-sum(term in terms for term in
+                                          self.documents[id]), -id))
+        return ranked[offset:offset + limit]
+
+
+BACKENDS = {
+    'sqlite': SQLiteSearch,
+    'postgres': PostgresSearch,
+    'memory': MemorySearch,
+}
+
+
+def get_backend():
+    """Returns the search backend of the current app.
+
+    SEARCH_BACKEND picks one of BACKENDS; when it isn't set, the backend
+    matching the database is used. Other databases have no full-text
+    backend: the memory one only sees the posts written by its own process,
+    so it has to be chosen explicitly."""
+    backend = current_app.extensions.get('search')
+    if backend is None:
+        name = current_app.config['SEARCH_BACKEND']
+        if name is None:
+            dialect = db.engine.dialect.name
+            name = {'sqlite': 'sqlite', 'postgresql': 'postgres'}.get(dialect)
+            if name is None:
+                raise ValueError(
+                    f'No search backend for {dialect} databases, set '
+                    'SEARCH_BACKEND to "memory" to use the in-process index')
+        backend = current_app.extensions['search'] = BACKENDS[name]()
+    return backend
+
+
+def search_posts(text, limit, offset=0):
+    """Returns the ids of the posts matching `text`, best match first."""
+    return get_backend().search(text, limit, offset)
+
+
+def reindex(chunk_size=1000):
+    """Rebuilds the search index, reading posts in chunks of `chunk_size`.
+    Returns the number of indexed posts."""
+    backend = get_backend()
+    connection = db.session.connection()
+    backend.create(connection)
+    backend.clear(connection)
+    total = last_id = 0
+    while True:
+        rows = db.session.execute(
+            sa.select(Post.id, Post.body).where(Post.id > last_id)
+            .order_by(Post.id).limit(chunk_size)
+        ).all()
+        if not rows:
+            break
+        backend.add(db.session.connection(), dict(rows))
+        db.session.commit()
+        total += len(rows)
+        last_id = rows[-1].id
+    db.session.commit()
+    return total
+
+
+# The FTS table isn't part of the metadata, so databases built with
+# db.create_all() get it from these events instead of the migration.
+
+@sa.event.listens_for(db.metadata, 'after_create')
+def _after_create(target, connection, **kw):
+    if connection.dialect.name == 'sqlite':
+        SQLiteSearch().create(connection)
+
+
+@sa.event.listens_for(db.metadata, 'after_drop')
+def _after_drop(target, connection, **kw):
+    if connection.dialect.name == 'sqlite':
+        connection.execute(sa.text('DROP TABLE IF EXISTS post_fts'))
+
+
+# Keeping the index in step with the post table. Changes are collected on
+# every flush; transactional backends write them right away on the flush's
+# connection, the others wait for the commit.
+
+def _collect(session, pending):
+    added, removed = {}, set()
+    for obj in session.new:
+        if isinstance(obj, Post):
+            added[obj.id] = obj.body
+    for obj in session.dirty:
+        if isinstance(obj, Post) and \
+                sa.inspect(obj).attrs.body.history.has_changes():
+            added[obj.id] = obj.body
+    for obj in session.deleted:
+        if isinstance(obj, Post):
+            removed.add(obj.id)
+    if not added and not removed:
+        return
+
+    backend = get_backend()
+    if backend.transactional:
+        connection = session.connection()
+        backend.add(connection, added)
+        backend.remove(connection, removed)
+    else:
+        pending_added, pending_removed = pending
+        pending_added.update(added)
+        pending_removed.update(removed)
+
+
+def _apply(pending):
+    added, removed = pending
+    if added or removed:
+        backend = get_backend()
+        backend.add(None, added)
+        backend.remove(None, removed)
+
+
+subscribe('search_pending', lambda: ({}, set()), _collect, _apply)
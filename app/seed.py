@@ -0,0 +1,163 @@
+"""Synthetic data for benchmarks and for testing migrations at production
+size, written by `flask seed`.
+
+Rows are generated lazily as tuples and written in batches of `batch_size`
+with executemany() on the DBAPI cursor, so memory use doesn't grow with the
+number of posts and SQLAlchemy never builds parameters row by row. Every
+user gets the same password, hashed once.
+"""
+import random
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from itertools import accumulate, islice
+
+import sqlalchemy as sa
+from flask import current_app
+from werkzeug.security import generate_password_hash
+
+from app import db
+from app.models import Post, User, followers, timeline
+
+
+# Placeholder of each DBAPI paramstyle that takes positional parameters
+_PLACEHOLDERS = {'qmark': '?', 'format': '%s', 'pyformat': '%s'}
+
+
+def _insert(table, columns, rows, batch_size):
+    """Writes the `rows` iterator of tuples, holding the values of
+    `columns`, to `table` in batches. Returns the number of rows written."""
+    # Values are passed to the driver as they are, so they must already be
+    # in a form it accepts
+    connection = db.session.connection()
+    dialect = connection.dialect
+    quote = dialect.identifier_preparer.quote
+    placeholder = _PLACEHOLDERS[dialect.paramstyle]
+    sql = (f'INSERT INTO {quote(table.name)} '
+           f'({", ".join(quote(column) for column in columns)}) '
+           f'VALUES ({", ".join([placeholder] * len(columns))})')
+    cursor = connection.connection.driver_connection.cursor()
+    total = 0
+    try:
+        while batch := list(islice(rows, batch_size)):
+            cursor.executemany(sql, batch)
+            total += len(batch)
+    finally:
+        cursor.close()
+    return total
+
+
+@contextmanager
+def _without_indexes(table):
+    """Drops the indexes of `table` for the duration of the `with` block.
+    Building an index once over all the rows is much faster than updating
+    it on every insert."""
+    connection = db.session.connection()
+    for index in table.indexes:
+        index.drop(connection, checkfirst=True)
+    yield
+    for index in table.indexes:
+        index.create(connection, checkfirst=True)
+
+
+_USER_COLUMNS = ('id', 'username', 'email', 'email_hash', 'password_hash',
+                 'last_seen', 'high_fanout', 'num_followers',
+                 'num_following', 'profile_version')
+
+
+def _users(first_id, n, password_hash, now):
+    for id in range(first_id, first_id + n):
+        email = f'user{id}@example.com'
+        yield (id, f'user{id}', email, User.hash_email(email),
+               password_hash, now, False, 0, 0, 0)
+
+
+def _follows(ids, rng, max_following, exponent, n_followers, n_following):
+    # The i-th user is followed with a weight of 1 / (i + 1) ** exponent,
+    # which gives a few users most of the followers
+    cum_weights = list(accumulate(1 / (i + 1) ** exponent
+                                  for i in range(len(ids))))
+    for follower in ids:
+        k = min(rng.randint(1, max_following), len(ids) - 1)
+        followed = set(rng.choices(ids, cum_weights=cum_weights, k=k))
+        followed.discard(follower)
+        n_following[follower] = len(followed)
+        for id in followed:
+            n_followers[id] += 1
+            yield follower, id
+
+
+def _posts(user_ids, n, rng, start, step, languages, timestamp):
+    random = rng.random
+    n_users = len(user_ids)
+    for i in range(n):
+        yield (f'Synthetic post number {i}',
+               user_ids[int(random() * n_users)],
+               languages[i % len(languages)],
+               timestamp(start + i * step))
+
+
+def seed(users, posts, max_following=50, exponent=1.2, days=365,
+         languages=('en',), password='password', batch_size=10000,
+         timelines=True, random_seed=0):
+    """Adds `users` users following each other and `posts` posts spread
+    over the last `days` days. Users follow between one and
+    `max_following` others, picked with a power law of `exponent`.
+
+    Follow counters are filled in, and with `timelines` the home
+    timelines are rebuilt. The post and timeline indexes are dropped while
+    those tables are written and built again afterwards. Returns the number
+    of rows written to each table."""
+    rng = random.Random(random_seed)
+    password_hash = generate_password_hash(
+        password, current_app.config['PASSWORD_HASH_METHOD'])
+    if db.engine.dialect.name == 'sqlite':
+        # Random inserts into the post indexes need a much larger page
+        # cache than the default 2 MB to stay fast
+        db.session.execute(sa.text('PRAGMA cache_size = -262144'))
+
+        # The format SQLAlchemy stores SQLite datetimes in
+        def timestamp(value):
+            return value.isoformat(' ', 'microseconds')
+    else:
+        def timestamp(value):
+            return value
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+
+    first_id = (db.session.scalar(sa.select(sa.func.max(User.id))) or 0) + 1
+    ids = list(range(first_id, first_id + users))
+    counts = {'user': _insert(
+        User.__table__, _USER_COLUMNS,
+        _users(first_id, users, password_hash, timestamp(now)), batch_size)}
+
+    n_followers, n_following = Counter(), Counter()
+    counts['followers'] = _insert(
+        followers, ('follower_id', 'followed_id'),
+        _follows(ids, rng, max_following, exponent, n_followers, n_following),
+        batch_size)
+    limit = current_app.config['TIMELINE_FANOUT_LIMIT']
+    db.session.execute(
+        sa.update(User.__table__)
+        .where(User.__table__.c.id == sa.bindparam('user_id'))
+        .values(num_followers=sa.bindparam('n_followers'),
+                num_following=sa.bindparam('n_following'),
+                high_fanout=sa.bindparam('high_fanout')),
+        [{'user_id': id, 'n_followers': n_followers[id],
+          'n_following': n_following[id],
+          'high_fanout': n_followers[id] > limit} for id in ids]
+    )
+
+    with _without_indexes(Post.__table__):
+        counts['post'] = _insert(
+            Post.__table__, ('body', 'user_id', 'language', 'time_stamp'),
+            _posts(ids, posts, rng, now - timedelta(days=days),
+                   timedelta(days=days) / max(posts, 1), list(languages),
+                   timestamp),
+            batch_size)
+    if timelines:
+        with _without_indexes(timeline):
+            User.rebuild_timelines()
+        counts['timeline'] = db.session.scalar(
+            sa.select(sa.func.count()).select_from(timeline))
+    db.session.commit()
+    return counts
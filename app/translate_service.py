@@ -1,15 +1,332 @@
+import asyncio
+import hashlib
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+
 import deepl
-import os
+import sqlalchemy as sa
+from asgiref.sync import sync_to_async
 from flask import current_app
+from sqlalchemy.dialects import postgresql, sqlite
+
+from app import db, metrics
+from app.cache import LRUCache
+from app.instrumentation import timed
+from app.models import CachedTranslation, Post, PostTranslation
+
+
+class DeepLTranslator:
+    """Translator backend that calls the DeepL API. One client, and so one
+    HTTP connection pool, is shared by all requests."""
+
+    def __init__(self, auth_key, max_connections=100):
+        if not auth_key:
+            current_app.logger.info('Could not authenticate the api key')
+        self.auth_key = auth_key
+        self.max_connections = max_connections
+        self.client = deepl.Translator(auth_key)
+        self.async_client = None
+
+    def translate_many(self, texts, source_lang, dest_lang):
+        # DeepL translates a list of texts in a single API call
+        results = self.client.translate_text(
+            texts, source_lang=source_lang or None, target_lang=dest_lang
+        )
+        return [result.text for result in results]
+
+    async def translate_many_async(self, texts, source_lang, dest_lang):
+        """Same as translate_many(), on an httpx client that doesn't hold a
+        thread while waiting for DeepL. The deepl package has no async
+        client, so this calls the REST API directly."""
+        if self.async_client is None:
+            import httpx
+            free = deepl.util.auth_key_is_free_account(self.auth_key or '')
+            self.async_client = httpx.AsyncClient(
+                base_url=('https://api-free.deepl.com' if free
+                          else 'https://api.deepl.com'),
+                headers={'Authorization': f'DeepL-Auth-Key {self.auth_key}'},
+                limits=httpx.Limits(max_connections=self.max_connections),
+            )
+        data = {'text': texts, 'target_lang': dest_lang}
+        if source_lang:
+            data['source_lang'] = source_lang
+        response = await self.async_client.post('/v2/translate', json=data)
+        response.raise_for_status()
+        return [result['text'] for result in response.json()['translations']]
+
+    async def aclose(self):
+        if self.async_client is not None:
+            await self.async_client.aclose()
+            self.async_client = None
+
+
+class FakeTranslator:
+    """Offline translator backend for tests and local development. It tags
+    the text with the destination language instead of translating it."""
+
+    def __init__(self):
+        self.calls = 0
+
+    def translate_many(self, texts, source_lang, dest_lang):
+        self.calls += 1
+        return [f'[{dest_lang}] {text}' for text in texts]
+
+    async def translate_many_async(self, texts, source_lang, dest_lang):
+        return self.translate_many(texts, source_lang, dest_lang)
+
+    async def aclose(self):
+        pass
+
+
+def get_translator():
+    """Returns the translator backend of the current app, creating it on
+    first use according to TRANSLATOR_BACKEND."""
+    translator = current_app.extensions.get('translator')
+    if translator is None:
+        backend = current_app.config['TRANSLATOR_BACKEND']
+        if backend == 'fake':
+            translator = FakeTranslator()
+        elif backend == 'deepl':
+            translator = DeepLTranslator(
+                current_app.config['DEEPL_API_KEY'],
+                current_app.config['TRANSLATOR_MAX_CONNECTIONS'])
+        else:
+            raise ValueError(f'Unknown translator backend {backend!r}')
+        current_app.extensions['translator'] = translator
+    return translator
+
+
+def _memory_cache():
+    cache = current_app.extensions.get('translation_cache')
+    if cache is None:
+        cache = LRUCache(current_app.config['TRANSLATION_CACHE_SIZE'],
+                         ttl=current_app.config['TRANSLATION_CACHE_TTL'])
+        current_app.extensions['translation_cache'] = cache
+    return cache
 
 
 def translate(text, source_lang, dest_lang):
-    auth_key = os.getenv('deepl_api_key')
-    if not auth_key:
-        current_app.logger.info('Could not authenticate the api key')
+    """Translates `text`, see translate_many()."""
+    return translate_many([text], source_lang, dest_lang)[0]
+
+
+async def translate_async(text, source_lang, dest_lang):
+    return (await translate_many_async([text], source_lang, dest_lang))[0]
+
+
+def translate_many(texts, source_lang, dest_lang):
+    """Translates a list of texts from one language pair.
+
+    Each text is looked up in the in-memory cache, then the ones still
+    missing in the translation_cache table with one query. Whatever is left
+    goes to the translator backend in a single call."""
+    source_lang = source_lang or ''
+    keys, found, pending = _cached_translations(texts, source_lang,
+                                                dest_lang)
+    if pending:
+        with timed('translate'):
+            translations = get_translator().translate_many(
+                list(pending.values()), source_lang, dest_lang)
+        _store_translations(found, pending, translations, source_lang,
+                            dest_lang)
+    return [found[key] for key in keys]
+
+
+async def translate_many_async(texts, source_lang, dest_lang):
+    """Same as translate_many(), awaiting the translator backend. The cache
+    queries run on asgiref's sync thread, so they don't block the event
+    loop."""
+    source_lang = source_lang or ''
+    keys, found, pending = await sync_to_async(_cached_translations)(
+        texts, source_lang, dest_lang)
+    if pending:
+        with timed('translate'):
+            translations = await get_translator().translate_many_async(
+                list(pending.values()), source_lang, dest_lang)
+        await sync_to_async(_store_translations)(
+            found, pending, translations, source_lang, dest_lang)
+    return [found[key] for key in keys]
+
+
+def _cached_translations(texts, source_lang, dest_lang):
+    """Looks `texts` up in both cache tiers. Returns the cache key of each
+    text, a {key: translation} dict of the ones found and a {key: text}
+    dict of the distinct texts still to translate, in the order they were
+    asked for."""
+    memory = _memory_cache()
+    keys = [(hashlib.sha256(text.encode()).hexdigest(), source_lang,
+             dest_lang) for text in texts]
+    found = {}
+    for key in keys:
+        translation = memory.get(key)
+        if translation is not None:
+            found[key] = translation
+    metrics.incr('translation_cache_memory_hits', len(found))
+
+    missing = {key for key in keys if key not in found}
+    if missing:
+        now = datetime.now(timezone.utc)
+        ttl = timedelta(seconds=current_app.config['TRANSLATION_CACHE_TTL'])
+        rows = db.session.scalars(sa.select(CachedTranslation).where(
+            CachedTranslation.source_lang == source_lang,
+            CachedTranslation.dest_lang == dest_lang,
+            CachedTranslation.text_hash.in_({key[0] for key in missing})
+        ))
+        for row in rows:
+            key = (row.text_hash, source_lang, dest_lang)
+            if not row.is_expired(now, ttl):
+                found[key] = row.translation
+                memory.set(key, row.translation)
+                missing.discard(key)
+                metrics.incr('translation_cache_db_hits')
+
+    pending = {}
+    for key, text in zip(keys, texts):
+        if key in missing:
+            pending.setdefault(key, text)
+    metrics.incr('translation_cache_misses', len(pending))
+    return keys, found, pending
+
+
+def _store_translations(found, pending, translations, source_lang,
+                        dest_lang):
+    """Adds the backend's `translations` of the `pending` texts to `found`
+    and to both cache tiers. The caller commits."""
+    memory = _memory_cache()
+    now = datetime.now(timezone.utc)
+    rows = []
+    for key, translation in zip(pending, translations):
+        found[key] = translation
+        memory.set(key, translation)
+        rows.append({'text_hash': key[0], 'source_lang': source_lang,
+                     'dest_lang': dest_lang, 'translation': translation,
+                     'created_at': now})
+    _upsert_translations(rows)
+
+
+def _upsert_translations(rows):
+    """Writes `rows` to the translation_cache table, replacing the entries
+    already there. Two requests translating the same text at once would
+    make a plain INSERT fail."""
+    table = CachedTranslation.__table__
+    dialect = db.session.get_bind().dialect.name
+    if dialect in ('sqlite', 'postgresql'):
+        insert = (sqlite.insert if dialect == 'sqlite'
+                  else postgresql.insert)(table)
+        db.session.execute(
+            insert.on_conflict_do_update(
+                index_elements=[column.name for column in table.primary_key],
+                set_={'translation': insert.excluded.translation,
+                      'created_at': insert.excluded.created_at}),
+            rows)
+        return
+    for row in rows:
+        try:
+            with db.session.begin_nested():
+                db.session.merge(CachedTranslation(**row))
+        except sa.exc.IntegrityError:
+            # Stored by a concurrent request in the meantime
+            pass
+
+
+def stored_translations(items):
+    """Looks up translations made by the pre-translation worker for
+    (post_id, dest_lang) pairs with one query. Returns a
+    {(post_id, dest_lang): text} dict."""
+    if not items:
+        return {}
+    rows = db.session.scalars(
+        sa.select(PostTranslation).where(
+            sa.tuple_(PostTranslation.post_id, PostTranslation.language)
+            .in_(set(items))
+        )
+    )
+    return {(row.post_id, row.language): row.body for row in rows}
+
+
+def batch_items(data):
+    """Validates the JSON body of a batch translation request,
+    {"items": [{"post_id": 1, "dest_lang": "en"}, ...]}, and returns its
+    (post_id, dest_lang) pairs. Raises ValueError if it is malformed."""
+    items = data.get('items') if isinstance(data, dict) else None
+    if not isinstance(items, list) or \
+            len(items) > current_app.config['TRANSLATE_BATCH_MAX']:
+        raise ValueError('items must be a list of at most '
+                         f'{current_app.config["TRANSLATE_BATCH_MAX"]}')
+    try:
+        return [(int(item['post_id']), str(item['dest_lang']))
+                for item in items]
+    except (KeyError, TypeError, ValueError):
+        raise ValueError('malformed item')
+
+
+def translate_posts(items):
+    """Translates many posts at once. `items` is a list of
+    (post_id, dest_lang) pairs.
+
+    Translations stored by the pre-translation worker are used as they are.
+    The remaining posts are loaded with one query and grouped by language
+    pair, so each pair costs at most one call to the translator backend.
+    Unknown post ids are skipped."""
+    translations, groups = _group_posts(items)
+    for (source_lang, dest_lang), group in groups.items():
+        texts = translate_many([post.body for post in group], source_lang,
+                               dest_lang)
+        translations.extend(_results(group, dest_lang, texts))
+    return translations
+
+
+async def translate_posts_async(items):
+    """Same as translate_posts(), with the language pairs translated
+    concurrently."""
+    translations, groups = await sync_to_async(_group_posts)(items)
+    results = await asyncio.gather(*(
+        translate_many_async([post.body for post in group], source_lang,
+                             dest_lang)
+        for (source_lang, dest_lang), group in groups.items()
+    ))
+    for ((_, dest_lang), group), texts in zip(groups.items(), results):
+        translations.extend(_results(group, dest_lang, texts))
+    return translations
+
+
+def _group_posts(items):
+    """Returns the stored translations of `items`, and the posts left to
+    translate grouped by language pair."""
+    translations = []
+    stored = stored_translations(items)
+    for (post_id, dest_lang), text in stored.items():
+        translations.append(
+            {'post_id': post_id, 'dest_lang': dest_lang, 'text': text})
+    items = [item for item in items if item not in stored]
+    groups = defaultdict(list)
+    if not items:
+        return translations, groups
+
+    posts = db.session.scalars(
+        sa.select(Post).where(Post.id.in_({post_id for post_id, _ in items}))
+    )
+    posts = {post.id: post for post in posts}
+    for post_id, dest_lang in items:
+        post = posts.get(post_id)
+        if post is not None:
+            groups[(post.language, dest_lang)].append(post)
+    return translations, groups
+
+
+def _results(posts, dest_lang, texts):
+    return [{'post_id': post.id, 'dest_lang': dest_lang, 'text': text}
+            for post, text in zip(posts, texts)]
 
-    translator = deepl.Translator(auth_key)
 
-    return translator.translate_text(
-        text, source_lang=source_lang, target_lang=dest_lang
-    ).text
+def purge_expired_translations():
+    """Deletes cached translations older than TRANSLATION_CACHE_TTL and
+    returns how many were removed."""
+    ttl = timedelta(seconds=current_app.config['TRANSLATION_CACHE_TTL'])
+    cutoff = datetime.now(timezone.utc) - ttl
+    result = db.session.execute(
+        sa.delete(CachedTranslation)
+        .where(CachedTranslation.created_at < cutoff)
+    )
+    db.session.commit()
+    return result.rowcount
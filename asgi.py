@@ -0,0 +1,9 @@
+"""ASGI entry point, for example `uvicorn asgi:app --workers 4`.
+
+See app/asgi.py for what is served asynchronously. microblog.py stays the
+entry point of the flask command and of WSGI servers.
+"""
+from app import create_app
+from app.asgi import AsyncApp
+
+app = AsyncApp(create_app())
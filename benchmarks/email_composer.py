@@ -0,0 +1,62 @@
+"""Messages composed per second: render_template() per recipient versus
+EmailComposer rendering a preloaded template pair.
+
+    python benchmarks/email_composer.py [recipients]
+"""
+import os
+import sys
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from flask import render_template  # noqa: E402
+from flask_mail import Message  # noqa: E402
+
+from app import create_app  # noqa: E402
+from app.email import EmailComposer  # noqa: E402
+from app.models import User  # noqa: E402
+from config import Config  # noqa: E402
+
+
+class BenchConfig(Config):
+    SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    USERNAME_INDEX_PRELOAD = False
+    TESTING = True
+
+
+def per_message(users, message):
+    messages = []
+    for user in users:
+        msg = Message(subject='News', recipients=[user.email],
+                      sender='admin@example.com')
+        msg.body = render_template('email/notification.txt', user=user,
+                                   message=message)
+        msg.html = render_template('email/notification.html', user=user,
+                                   message=message)
+        messages.append(msg)
+    return messages
+
+
+def composer(users, message):
+    return EmailComposer('email/notification', 'News').compose(
+        users, message=message)
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    users = [User(username=f'user{i}', email=f'user{i}@example.com')
+             for i in range(n)]
+    app = create_app(BenchConfig)
+    with app.test_request_context():
+        for name, compose in (('render_template', per_message),
+                              ('EmailComposer', composer)):
+            compose(users[:10], 'warm up')
+            start = perf_counter()
+            compose(users, 'Microblog has a new look!')
+            elapsed = perf_counter() - start
+            print(f'{name:<16}{n / elapsed:>10.0f} messages/s')
+
+
+if __name__ == '__main__':
+    main()
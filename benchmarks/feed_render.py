@@ -0,0 +1,74 @@
+"""Render time of the /index and /explore feeds with every post rendered
+from _post.html versus read from the rendered post cache.
+
+    python benchmarks/feed_render.py [rounds]
+"""
+import os
+import sys
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from flask import current_app, g, render_template  # noqa: E402
+
+from app import create_app, db  # noqa: E402
+from app.models import Post, User  # noqa: E402
+from config import Config  # noqa: E402
+
+
+class BenchConfig(Config):
+    SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    USERNAME_INDEX_PRELOAD = False
+    TESTING = True
+    PAGE_CACHE_ENABLED = False
+    SEARCH_BACKEND = 'memory'
+
+
+def populate():
+    users = [User(username=f'user{i}', email=f'user{i}@example.com')
+             for i in range(50)]
+    db.session.add_all(users)
+    for i in range(500):
+        db.session.add(Post(body=f'post number {i}', author=users[i % 50],
+                            language='es' if i % 3 else 'en'))
+    db.session.commit()
+    reader = users[0]
+    for user in users[1:]:
+        reader.follow(user)
+    db.session.commit()
+    return reader
+
+
+def render_feed(query):
+    posts = db.session.scalars(
+        query.limit(current_app.config['POSTS_PER_PAGE'])).all()
+    return render_template('_feed.html', posts=posts, next_url=None,
+                           prev_url=None)
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    app = create_app(BenchConfig)
+    with app.app_context():
+        db.create_all()
+        reader = populate()
+        feeds = (('/index', reader.home_timeline()),
+                 ('/explore', Post.feed()))
+        with app.test_request_context():
+            g.locale = 'en'
+            for name, query in feeds:
+                for cached in (False, True):
+                    render_feed(query)
+                    start = perf_counter()
+                    for _ in range(rounds):
+                        if not cached:
+                            app.extensions['post_fragments'].clear()
+                        render_feed(query)
+                    elapsed = (perf_counter() - start) / rounds
+                    label = 'cached' if cached else 'uncached'
+                    print(f'{name:<10}{label:<10}{elapsed * 1000:>8.2f} ms')
+
+
+if __name__ == '__main__':
+    main()
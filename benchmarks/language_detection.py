@@ -0,0 +1,89 @@
+"""Post-submit latency of language detection, before and after preloading.
+
+Each mode runs in a fresh process, because langdetect loads its profiles
+once per process and the first post is the one that pays for it:
+
+    python benchmarks/language_detection.py
+"""
+import os
+import subprocess
+import sys
+import tempfile
+from statistics import median
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+POSTS = [
+    'Hello everyone, this is my first post here',
+    'سلام به همه، این اولین پست من است',
+    'Bonjour tout le monde, ceci est mon premier message',
+    'Hallo zusammen, das ist mein erster Beitrag',
+] * 25
+
+# name: (LANGDETECT_PRELOAD, LANGDETECT_ASYNC)
+MODES = {
+    'lazy (before)': (False, False),
+    'preloaded': (True, False),
+    'async': (True, True),
+}
+
+
+def run(preload, run_async):
+    """Creates an app and submits POSTS through the detection step of
+    main.index, timing each one. Prints the timings in milliseconds."""
+    from app import create_app, db
+    from app.language import detect_in_background, detect_language
+    from app.models import Post, User
+    from config import Config
+
+    # A file database, the async mode writes from other threads
+    db_file = os.path.join(tempfile.mkdtemp(), 'bench.db')
+
+    class BenchConfig(Config):
+        SQLALCHEMY_DATABASE_URI = f'sqlite:///{db_file}'
+        TESTING = True
+        LANGDETECT_PRELOAD = preload
+        LANGDETECT_ASYNC = run_async
+
+    app = create_app(BenchConfig)
+    with app.app_context():
+        db.create_all()
+        user = User(username='bench', email='bench@example.com')
+        db.session.add(user)
+        db.session.commit()
+        timings = []
+        futures = []
+        for body in POSTS:
+            start = perf_counter()
+            language = None if run_async else detect_language(body)
+            post = Post(body=body, author=user, language=language)
+            db.session.add(post)
+            db.session.commit()
+            if language is None:
+                futures.append(detect_in_background(post))
+            timings.append((perf_counter() - start) * 1000)
+        for future in futures:
+            future.result()
+    print(' '.join(f'{t:.3f}' for t in timings))
+
+
+def main():
+    print(f"{'mode':<16}{'first post':>12}{'median':>10}{'max rest':>10}")
+    for name, (preload, run_async) in MODES.items():
+        out = subprocess.run(
+            [sys.executable, __file__, str(int(preload)),
+             str(int(run_async))],
+            check=True, capture_output=True, text=True
+        ).stdout.split('\n')[-2]
+        timings = [float(t) for t in out.split()]
+        print(f'{name:<16}{timings[0]:>10.2f}ms{median(timings):>8.2f}ms'
+              f'{max(timings[1:]):>8.2f}ms')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 3:
+        run(bool(int(sys.argv[1])), bool(int(sys.argv[2])))
+    else:
+        main()
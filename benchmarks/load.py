@@ -0,0 +1,241 @@
+"""Load benchmark of the main and auth blueprints.
+
+Seeds a synthetic social graph, with followers drawn from a power law so a
+few users have most of them, then drives the pages people use the most:
+/index, /explore, /user/<username>, follow/unfollow, writing a post and
+logging in. Every scenario runs through the Flask test client, and with
+--server also over HTTP against a threaded WSGI server. For each one it
+prints p50/p99 latency, requests per second and SQL queries per request.
+--output saves the results as JSON, to compare them between commits.
+
+    python benchmarks/load.py [--users 1000] [--posts 20000]
+                              [--requests 200] [--database URI]
+                              [--server] [--concurrency 8]
+                              [--output results.json]
+
+The default database is a fresh SQLite file in a temporary directory. Give
+--database to use a local Postgres instead; all of its tables are dropped
+and created again.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+from datetime import datetime, timezone
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import requests  # noqa: E402
+from werkzeug.serving import make_server  # noqa: E402
+
+from app import create_app, db, metrics  # noqa: E402
+from app.seed import seed  # noqa: E402
+from config import Config  # noqa: E402
+
+PASSWORD = 'benchmark'
+
+
+def bench_config(database):
+    class BenchConfig(Config):
+        SQLALCHEMY_DATABASE_URI = database
+        TESTING = True
+        SECRET_KEY = 'benchmark'
+        WTF_CSRF_ENABLED = False
+        TRANSLATOR_BACKEND = 'fake'
+        MAIL_OUTBOX = True
+        SLOW_QUERY_THRESHOLD = None
+        SLOW_REQUEST_THRESHOLD = None
+    return BenchConfig
+
+
+def scenarios(n_users, rng):
+    """Returns (name, method, path function, form data, logged in) tuples.
+    Paths are functions so each request can pick a different user."""
+    def other_user():
+        return f'user{rng.randrange(2, n_users + 1)}'
+
+    return [
+        ('index', 'GET', lambda: '/index', None, True),
+        ('explore', 'GET', lambda: '/explore', None, True),
+        ('user', 'GET', lambda: f'/user/{other_user()}', None, True),
+        ('follow', 'POST', lambda: f'/follow/{other_user()}', {}, True),
+        ('unfollow', 'POST', lambda: f'/unfollow/{other_user()}', {}, True),
+        ('post', 'POST', lambda: '/index',
+         {'post': 'Writing a post from the load benchmark'}, True),
+        ('login', 'POST', lambda: '/auth/login',
+         {'username': 'user1', 'password': PASSWORD}, False),
+    ]
+
+
+def summarize(latencies, elapsed, queries):
+    latencies = sorted(latencies)
+
+    def percentile(q):
+        return latencies[min(len(latencies) - 1,
+                             round(q * (len(latencies) - 1)))]
+
+    return {
+        'requests': len(latencies),
+        'p50_ms': round(percentile(0.50) * 1000, 3),
+        'p99_ms': round(percentile(0.99) * 1000, 3),
+        'requests_per_second': round(len(latencies) / elapsed, 1),
+        'queries_per_request': round(queries / len(latencies), 2),
+    }
+
+
+def run_test_client(app, n_users, n_requests, rng):
+    client = app.test_client()
+    client.post('/auth/login', data={'username': 'user1',
+                                     'password': PASSWORD})
+    results = {}
+    for name, method, path, data, logged_in in scenarios(n_users, rng):
+        latencies = []
+        queries = metrics.get('sql_calls')
+        start = perf_counter()
+        for _ in range(n_requests):
+            # Logged out requests get a client without a session cookie
+            c = client if logged_in else app.test_client()
+            t = perf_counter()
+            response = c.open(path(), method=method, data=data)
+            latencies.append(perf_counter() - t)
+            if response.status_code >= 400:
+                raise RuntimeError(f'{name}: {response.status_code}')
+        results[name] = summarize(latencies, perf_counter() - start,
+                                  metrics.get('sql_calls') - queries)
+    return results
+
+
+def run_server(app, n_users, n_requests, concurrency, rng):
+    # Keep the server from logging every request
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f'http://127.0.0.1:{server.server_port}'
+
+    sessions = []
+    for i in range(concurrency):
+        session = requests.Session()
+        session.post(f'{base}/auth/login',
+                     data={'username': f'user{i + 1}', 'password': PASSWORD})
+        sessions.append(session)
+
+    results = {}
+    try:
+        for name, method, path, data, logged_in in scenarios(n_users, rng):
+            latencies = [[] for _ in range(concurrency)]
+            errors = []
+            paths = [path() for _ in range(n_requests)]
+
+            def worker(i):
+                for p in paths[i::concurrency]:
+                    t = perf_counter()
+                    session = sessions[i] if logged_in else requests
+                    response = session.request(
+                        method, base + p, data=data, allow_redirects=False)
+                    latencies[i].append(perf_counter() - t)
+                    if response.status_code >= 400:
+                        errors.append(response.status_code)
+
+            queries = metrics.get('sql_calls')
+            start = perf_counter()
+            threads = [threading.Thread(target=worker, args=(i,))
+                       for i in range(concurrency)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            if errors:
+                raise RuntimeError(f'{name}: {errors[0]}')
+            results[name] = summarize(
+                [t for ts in latencies for t in ts],
+                perf_counter() - start, metrics.get('sql_calls') - queries)
+    finally:
+        server.shutdown()
+    return results
+
+
+def print_results(mode, results):
+    print(f'{mode}:')
+    print(f'  {"scenario":<10}{"p50 ms":>10}{"p99 ms":>10}{"req/s":>10}'
+          f'{"queries":>10}')
+    for name, r in results.items():
+        print(f'  {name:<10}{r["p50_ms"]:>10.2f}{r["p99_ms"]:>10.2f}'
+              f'{r["requests_per_second"]:>10.1f}'
+              f'{r["queries_per_request"]:>10.2f}')
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+            text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--posts', type=int, default=20000)
+    parser.add_argument('--requests', type=int, default=200,
+                        help='requests per scenario')
+    parser.add_argument('--database', help='SQLAlchemy database URI')
+    parser.add_argument('--server', action='store_true',
+                        help='also run against a threaded WSGI server')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the results to this file')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        database = args.database or f'sqlite:///{tmpdir}/bench.db'
+        app = create_app(bench_config(database))
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+            start = perf_counter()
+            seed(args.users, args.posts, password=PASSWORD,
+                 random_seed=args.seed)
+            print(f'Seeded {args.users} users and {args.posts} posts in '
+                  f'{perf_counter() - start:.1f}s')
+            dialect = db.engine.dialect.name
+
+        results = {'test_client': run_test_client(app, args.users,
+                                                  args.requests, rng)}
+        print_results('test client', results['test_client'])
+        if args.server:
+            results['server'] = run_server(app, args.users, args.requests,
+                                           args.concurrency, rng)
+            print_results(f'server ({args.concurrency} clients)',
+                          results['server'])
+        with app.app_context():
+            db.engine.dispose()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'commit': git_commit(),
+                'date': datetime.now(timezone.utc).isoformat(),
+                'python': platform.python_version(),
+                'database': dialect,
+                'users': args.users,
+                'posts': args.posts,
+                'requests': args.requests,
+                'concurrency': args.concurrency if args.server else None,
+                'results': results,
+            }, f, indent=2)
+        print(f'Results written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
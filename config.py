@@ -7,13 +7,152 @@ basedir = Path(__file__).resolve().parent
 load_dotenv(os.path.join(basedir, '.env'))
 
 
+def _env_int(name, default=None):
+    value = os.environ.get(name)
+    return int(value) if value else default
+
+
 class Config:
     SECRET_KEY = os.getenv('SECRET_KEY')
     SQLALCHEMY_DATABASE_URI = os.environ.get("DATABASE_URI") or \
         f'sqlite:///{basedir / "app.db"}'
+    # Engine and connection pool, see app/engine.py. Each gunicorn worker
+    # has its own pool, so DB_POOL_SIZE + DB_MAX_OVERFLOW should cover the
+    # threads of one worker. Unset variables keep SQLAlchemy's defaults.
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        key: value for key, value in {
+            'pool_size': _env_int('DB_POOL_SIZE'),
+            'max_overflow': _env_int('DB_MAX_OVERFLOW'),
+            'pool_timeout': _env_int('DB_POOL_TIMEOUT'),
+            'pool_recycle': _env_int('DB_POOL_RECYCLE'),
+            'pool_pre_ping': os.environ.get('DB_POOL_PRE_PING') == '1',
+        }.items() if value not in (None, False)
+    }
+    # Milliseconds before Postgres or MySQL cancels a statement
+    DB_STATEMENT_TIMEOUT = _env_int('DB_STATEMENT_TIMEOUT')
+    # Applied to every new SQLite connection. WAL lets readers work while
+    # another connection writes.
+    SQLITE_PRAGMAS = {
+        'journal_mode': os.environ.get('SQLITE_JOURNAL_MODE') or 'wal',
+        'synchronous': os.environ.get('SQLITE_SYNCHRONOUS') or 'normal',
+        'busy_timeout': _env_int('SQLITE_BUSY_TIMEOUT', 5000),
+        'mmap_size': _env_int('SQLITE_MMAP_SIZE', 256 * 1024 * 1024),
+    }
+
+    # Request timing and SQL instrumentation, see app/instrumentation.py
+    INSTRUMENTATION_ENABLED = True
+    # Serve the counters at /metrics for Prometheus. They describe the
+    # internals of the site, so the endpoint is off unless asked for, and
+    # with METRICS_TOKEN set it needs an "Authorization: Bearer" header.
+    METRICS_ENDPOINT = os.environ.get('METRICS_ENDPOINT') == '1'
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+    # Log a JSON line with the timings of every request
+    REQUEST_LOG = os.environ.get('REQUEST_LOG') == '1'
+    # Seconds after which a statement or a request is logged as slow, None
+    # to never log them
+    SLOW_QUERY_THRESHOLD = float(
+        os.environ.get('SLOW_QUERY_THRESHOLD') or 0.1)
+    SLOW_REQUEST_THRESHOLD = float(
+        os.environ.get('SLOW_REQUEST_THRESHOLD') or 1.0)
 
     ADMINS = ['forghani.dev@gmail.com']
 
+    MAIL_SERVER = os.environ.get('MAIL_SERVER') or 'localhost'
+    MAIL_PORT = int(os.environ.get('MAIL_PORT') or 25)
+    # Emails are sent by MAIL_WORKERS threads from a queue holding at most
+    # MAIL_QUEUE_SIZE messages. A full queue makes send_email() wait up to
+    # MAIL_QUEUE_TIMEOUT seconds before the message is dropped.
+    MAIL_WORKERS = 2
+    MAIL_QUEUE_SIZE = 1000
+    MAIL_QUEUE_TIMEOUT = 5
+    # Messages sent over one SMTP connection
+    MAIL_BATCH_SIZE = 20
+    MAIL_MAX_RETRIES = 3
+    # Seconds before the first retry, doubled on every retry
+    MAIL_RETRY_DELAY = 1
+    # Write emails to the outbox table and send them from a separate
+    # `flask outbox work` process instead of the web workers
+    MAIL_OUTBOX = os.environ.get('MAIL_OUTBOX') == '1'
+    # Seconds an outbox worker owns the rows it claimed
+    MAIL_OUTBOX_LEASE = 300
+
     MIN_PASSWORD_LENGTH = 4
+    # Password hashing, see app/passwords.py. Users whose hash was made
+    # with another method are rehashed on their next login.
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD') or \
+        'scrypt:32768:8:1'
+    PASSWORD_HASH_WORKERS = _env_int('PASSWORD_HASH_WORKERS', 2)
+    PASSWORD_HASH_QUEUE_SIZE = 32
+    PASSWORD_HASH_QUEUE_TIMEOUT = 5
+    # Failed logins allowed per username and per client address within
+    # LOGIN_FAILURE_WINDOW seconds
+    LOGIN_MAX_FAILURES_PER_USERNAME = 5
+    LOGIN_MAX_FAILURES_PER_IP = 20
+    LOGIN_FAILURE_WINDOW = 300
+    # Number of reverse proxies in front of the app. Their X-Forwarded-For
+    # header then gives the client address used by the per-address login
+    # limit; without it every client behind a proxy shares one address.
+    PROXY_FIX_X_FOR = _env_int('PROXY_FIX_X_FOR', 0)
     POSTS_PER_PAGE = 10
     LANGUAGES = ['en', 'fa']
+    # Authors with more followers than this are merged into home timelines
+    # on read instead of being fanned out to every follower on write.
+    TIMELINE_FANOUT_LIMIT = int(os.environ.get('TIMELINE_FANOUT_LIMIT')
+                                or 1000)
+    # 'deepl' calls the DeepL API, 'fake' is an offline stand-in for tests
+    TRANSLATOR_BACKEND = os.environ.get('TRANSLATOR_BACKEND') or 'deepl'
+    DEEPL_API_KEY = os.getenv('deepl_api_key')
+    # Concurrent DeepL connections of the async client used under ASGI
+    TRANSLATOR_MAX_CONNECTIONS = int(
+        os.environ.get('TRANSLATOR_MAX_CONNECTIONS') or 100)
+    # Entries kept in the in-memory translation cache, and how long (in
+    # seconds) a cached translation is reused before asking DeepL again
+    TRANSLATION_CACHE_SIZE = 1024
+    TRANSLATION_CACHE_TTL = int(os.environ.get('TRANSLATION_CACHE_TTL')
+                                or 30 * 24 * 3600)
+    # Largest number of posts accepted by one /translate/batch request
+    TRANSLATE_BATCH_MAX = 100
+    # Translate new posts in the background with `flask pretranslate work`
+    PRETRANSLATE_POSTS = os.environ.get('PRETRANSLATE_POSTS') == '1'
+    PRETRANSLATE_WORKERS = 4
+    PRETRANSLATE_BATCH_SIZE = 50
+    PRETRANSLATE_MAX_ATTEMPTS = 5
+    # Seconds before the first retry of a failed job, doubled on every retry
+    PRETRANSLATE_RETRY_DELAY = 30
+    # Seconds a claimed job is hidden from other workers
+    PRETRANSLATE_LEASE = 300
+    # Load langdetect's profiles at startup instead of on the first post,
+    # and seed it so a text is always given the same language
+    LANGDETECT_PRELOAD = True
+    LANGDETECT_SEED = 0
+    # Detect the language of new posts after the response is sent
+    LANGDETECT_ASYNC = os.environ.get('LANGDETECT_ASYNC') == '1'
+    LANGDETECT_WORKERS = 2
+    # Full-text search backend: 'sqlite' (FTS5), 'postgres' (tsvector) or
+    # 'memory'. Defaults to the one matching the database; on databases
+    # other than SQLite and PostgreSQL it must be set.
+    SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND')
+    # Build the in-memory username autocomplete index at startup, on a
+    # background thread that rebuilds it every USERNAME_INDEX_TTL seconds to
+    # refresh the follower counts used for ranking
+    USERNAME_INDEX_PRELOAD = True
+    USERNAME_INDEX_TTL = 300
+    AUTOCOMPLETE_LIMIT = 10
+    # Cache of the rendered explore feed. 'memory' keeps it per process,
+    # 'redis' shares it between processes through PAGE_CACHE_REDIS_URL.
+    PAGE_CACHE_ENABLED = True
+    PAGE_CACHE_BACKEND = os.environ.get('PAGE_CACHE_BACKEND') or 'memory'
+    PAGE_CACHE_REDIS_URL = os.environ.get('PAGE_CACHE_REDIS_URL') or \
+        'redis://localhost:6379/0'
+    PAGE_CACHE_SIZE = 256
+    PAGE_CACHE_TTL = 30
+    # Rendered posts kept in memory, see page_cache.render_post()
+    POST_FRAGMENT_CACHE_SIZE = 2048
+    # Logged in users kept in memory by identity.load_user(), so most
+    # requests don't have to load current_user from the database
+    IDENTITY_CACHE_ENABLED = True
+    IDENTITY_CACHE_SIZE = 10000
+    IDENTITY_CACHE_TTL = 30
+    # Minimum number of seconds between two writes of User.last_seen
+    LAST_SEEN_UPDATE_INTERVAL = int(os.environ.get('LAST_SEEN_UPDATE_INTERVAL')
+                                    or 60)
@@ -1,10 +1,16 @@
+from time import perf_counter
+
 import click
 import sqlalchemy as sa
 import sqlalchemy.orm as so
 from flask.cli import with_appcontext
 
-from app import create_app, db
-from app.models import Post, User
+from app import create_app, db, pretranslate, search
+from app.email import (EmailComposer, drain_outbox, get_dispatcher,
+                       send_messages_later, work_outbox)
+from app.models import Post, User, timeline
+from app.seed import seed
+from app.translate_service import purge_expired_translations
 
 app = create_app()
 
@@ -34,3 +40,179 @@ print("Registering custom shell")
 app.cli.add_command(shell_command, name='pshell')
 
 print("custom command registered")
+
+
+@click.command('seed', short_help='Fills the database with synthetic data.')
+@click.option('--users', default=1000, show_default=True)
+@click.option('--posts', default=10000, show_default=True)
+@click.option('--max-following', default=50, show_default=True,
+              help='Most users a single user follows.')
+@click.option('--exponent', default=1.2, show_default=True,
+              help='Power-law exponent of the follower distribution.')
+@click.option('--days', default=365, show_default=True,
+              help='Posts are spread over this many past days.')
+@click.option('--languages', default='en', show_default=True,
+              help='Comma-separated languages given to the posts.')
+@click.option('--password', default='password', show_default=True,
+              help='Password of every seeded user.')
+@click.option('--batch-size', default=10000, show_default=True,
+              help='Rows per INSERT executemany.')
+@click.option('--timelines/--no-timelines', default=True,
+              help='Rebuild the home timelines afterwards.')
+@click.option('--seed', 'random_seed', default=0, show_default=True,
+              help='Random seed, the same seed gives the same data.')
+@with_appcontext
+def seed_command(users, posts, max_following, exponent, days, languages,
+                 password, batch_size, timelines, random_seed):
+    """Add synthetic users, follows and posts with bulk inserts."""
+    start = perf_counter()
+    counts = seed(users, posts, max_following=max_following,
+                  exponent=exponent, days=days,
+                  languages=languages.split(','), password=password,
+                  batch_size=batch_size, timelines=timelines,
+                  random_seed=random_seed)
+    elapsed = perf_counter() - start
+    rows = sum(counts.values())
+    click.echo(', '.join(f'{count} {table}' for table, count in
+                         counts.items()))
+    click.echo(f"Wrote {rows} rows in {elapsed:.1f}s "
+               f"({rows / elapsed:.0f} rows/s)")
+    click.echo("Run `flask search-reindex` to make the posts searchable")
+
+
+app.cli.add_command(seed_command, name='seed')
+
+
+@click.command('timeline-backfill',
+               short_help='Rebuilds the home timelines of all users.')
+@with_appcontext
+def timeline_backfill_command():
+    """Fill the timeline table from the existing posts and followers."""
+    User.rebuild_timelines()
+    db.session.commit()
+    count = db.session.scalar(
+        sa.select(sa.func.count()).select_from(timeline))
+    click.echo(f"Timeline rebuilt with {count} entries")
+
+
+app.cli.add_command(timeline_backfill_command, name='timeline-backfill')
+
+
+@click.command('reconcile-counts',
+               short_help='Repairs the cached follower counters.')
+@with_appcontext
+def reconcile_counts_command():
+    """Recompute num_followers/num_following from the followers table."""
+    repaired = User.reconcile_follow_counts()
+    db.session.commit()
+    click.echo(f"Repaired follow counters of {repaired} users")
+
+
+app.cli.add_command(reconcile_counts_command, name='reconcile-counts')
+
+
+@click.command('translations-purge',
+               short_help='Deletes expired cached translations.')
+@with_appcontext
+def translations_purge_command():
+    """Remove translations older than TRANSLATION_CACHE_TTL."""
+    removed = purge_expired_translations()
+    click.echo(f"Removed {removed} expired translations")
+
+
+app.cli.add_command(translations_purge_command, name='translations-purge')
+
+
+@click.group('pretranslate', short_help='Runs the pre-translation queue.')
+def pretranslate_group():
+    """Translate queued posts in the background."""
+
+
+@pretranslate_group.command('drain')
+@with_appcontext
+def pretranslate_drain_command():
+    """Process queued translations until none are due."""
+    click.echo(f"Processed {pretranslate.drain()} translation jobs")
+
+
+@pretranslate_group.command('work')
+@click.option('--poll-interval', default=5.0,
+              help='Seconds to wait when the queue is empty.')
+@with_appcontext
+def pretranslate_work_command(poll_interval):
+    """Process queued translations until interrupted."""
+    pretranslate.work(poll_interval)
+
+
+@pretranslate_group.command('replay')
+@with_appcontext
+def pretranslate_replay_command():
+    """Requeue translation jobs that ran out of attempts."""
+    click.echo(f"Requeued {pretranslate.replay_failed()} translation jobs")
+
+
+app.cli.add_command(pretranslate_group, name='pretranslate')
+
+
+@click.group('outbox', short_help='Sends emails queued in the outbox.')
+def outbox_group():
+    """Send the emails stored in the outbox table."""
+
+
+@outbox_group.command('drain')
+@with_appcontext
+def outbox_drain_command():
+    """Send queued emails until none are due."""
+    click.echo(f"Processed {drain_outbox()} emails")
+
+
+@outbox_group.command('work')
+@click.option('--poll-interval', default=5.0,
+              help='Seconds to wait when the outbox is empty.')
+@with_appcontext
+def outbox_work_command(poll_interval):
+    """Send queued emails until interrupted."""
+    work_outbox(poll_interval)
+
+
+app.cli.add_command(outbox_group, name='outbox')
+
+
+@click.command('notify-users', short_help='Emails a message to all users.')
+@click.argument('subject')
+@click.argument('message')
+@click.option('--batch-size', default=500,
+              help='Users composed and queued at a time.')
+@with_appcontext
+def notify_users_command(subject, message, batch_size):
+    """Send SUBJECT and MESSAGE to every user."""
+    composer = EmailComposer('email/notification', subject)
+    total = last_id = 0
+    while True:
+        batch = db.session.scalars(
+            sa.select(User).where(User.id > last_id).order_by(User.id)
+            .limit(batch_size)).all()
+        if not batch:
+            break
+        send_messages_later(composer.compose(batch, message=message))
+        db.session.commit()
+        total += len(batch)
+        last_id = batch[-1].id
+    # Wait for the emails that went to the in-process dispatcher
+    get_dispatcher().shutdown()
+    click.echo(f"Queued {total} emails")
+
+
+app.cli.add_command(notify_users_command, name='notify-users')
+
+
+@click.command('search-reindex', short_help='Rebuilds the post search index.')
+@click.option('--chunk-size', default=1000,
+              help='Posts read and indexed at a time.')
+@with_appcontext
+def search_reindex_command(chunk_size):
+    """Index every post with the configured search backend."""
+    click.echo(f"Indexed {search.reindex(chunk_size)} posts")
+
+
+app.cli.add_command(search_reindex_command, name='search-reindex')
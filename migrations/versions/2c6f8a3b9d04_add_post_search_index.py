@@ -0,0 +1,35 @@
+"""Add post search index
+
+Revision ID: 2c6f8a3b9d04
+Revises: 7b34c9e0d512
+Create Date: 2026-10-18 16:22:48.017365
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2c6f8a3b9d04'
+down_revision = '7b34c9e0d512'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'postgresql':
+        op.execute("CREATE INDEX ix_post_body_tsvector ON post "
+                   "USING gin (to_tsvector('simple', body))")
+    elif dialect == 'sqlite':
+        op.execute('CREATE VIRTUAL TABLE post_fts USING fts5(body)')
+        op.execute('INSERT INTO post_fts (rowid, body) '
+                   'SELECT id, body FROM post')
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'postgresql':
+        op.drop_index('ix_post_body_tsvector', table_name='post')
+    elif dialect == 'sqlite':
+        op.execute('DROP TABLE post_fts')
@@ -1,19 +1,61 @@
+import asyncio
+import json
+import smtplib
+import tempfile
 import unittest
 from datetime import datetime, timedelta, timezone
+from unittest import mock
 
-from app import create_app, db
-from app.models import Post, User
+import flask_mail
+import sqlalchemy as sa
+from flask import g, render_template, session
+from flask_login import login_user
+from markupsafe import Markup
+from sqlalchemy.pool import QueuePool
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+from app import create_app, db, mail
+from app.asgi import AsyncApp
+from app.auth.throttle import SlidingWindow
+from app.autocomplete import complete_username, get_index
+from app.engine import TimedQueuePool, pool_stats
+from app.identity import load_user
+from app.email import (EmailComposer, claim_outbox, drain_outbox,
+                       get_dispatcher, process_outbox, send_email,
+                       send_messages_later)
+from app import metrics, pretranslate, search
+from app.language import detect_in_background, detect_language
+from app.models import (CachedTranslation, Outbox, Post, PostTranslation,
+                        TranslationJob, User, followers)
+from app.page_cache import cached_fragment, render_post
+from app.pagination import decode_cursor, encode_cursor, keyset_paginate
+from app.passwords import needs_rehash
+from app.search import search_posts
+from app.seed import seed
+from app.translate_service import (get_translator,
+                                   purge_expired_translations,
+                                   stored_translations, translate)
 from config import Config
 
 
 class TestConfig(Config):
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
     TESTING = True
+    SECRET_KEY = 'test'
+    TRANSLATOR_BACKEND = 'fake'
+    USERNAME_INDEX_PRELOAD = False
+    # Cheap hashes, computed in the test's thread
+    PASSWORD_HASH_METHOD = 'pbkdf2:sha256:1000'
+    PASSWORD_HASH_WORKERS = 0
+
 
+class AppTestCase(unittest.TestCase):
+    """Runs every test in an app context with an empty in-memory database.
+    Subclasses can replace `config`."""
+    config = TestConfig
 
-class UserModelCase(unittest.TestCase):
     def setUp(self):
-        self.app = create_app(TestConfig)
+        self.app = create_app(self.config)
         self.app_context = self.app.app_context()
         self.app_context.push()
         db.create_all()
@@ -23,6 +65,31 @@ class UserModelCase(unittest.TestCase):
         db.drop_all()
         self.app_context.pop()
 
+    def login_client(self, user):
+        """Returns a test client whose session is logged in as `user`."""
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = user.get_id()
+        return client
+
+
+class QueryCounter:
+    """Counts the SQL statements sent to the database inside a `with`
+    block."""
+
+    def __enter__(self):
+        self.count = 0
+        sa.event.listen(db.engine, 'before_cursor_execute', self._count)
+        return self
+
+    def __exit__(self, *exc):
+        sa.event.remove(db.engine, 'before_cursor_execute', self._count)
+
+    def _count(self, *args):
+        self.count += 1
+
+
+class UserModelCase(AppTestCase):
     def test_password_hashing(self):
         u = User(username='susan', email='susan@example.com')
         u.set_password('cat')
@@ -35,6 +102,37 @@ class UserModelCase(unittest.TestCase):
                                          'd4c74594d841139328695756648b6bd6'
                                          '?s=128&d=mp'))
 
+        # the hash follows email changes
+        u.email = ' Susan@Example.com'
+        self.assertEqual(u.email_hash, User.hash_email('susan@example.com'))
+        self.assertEqual(
+            User.avatars([u, User(email='john@example.com')], 36),
+            [u.avatar(36), ('https://www.gravatar.com/avatar/'
+                            'd4c74594d841139328695756648b6bd6?s=36&d=mp')])
+
+    def test_detect_language(self):
+        text = 'Hello everyone, this is my first post here'
+        self.assertEqual(detect_language(text), 'en')
+        # seeded, so the answer never changes between calls
+        self.assertEqual({detect_language(text) for _ in range(5)}, {'en'})
+        self.assertEqual(detect_language('12345'), '')
+
+    def test_touch(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        # a fresh user was just seen, so there is nothing to write
+        self.assertFalse(u.touch())
+
+        u.last_seen = datetime.now(timezone.utc) - timedelta(hours=1)
+        db.session.commit()
+        self.assertTrue(u.touch())
+        db.session.commit()
+        self.assertFalse(u.touch())
+
+        self.app.config['LAST_SEEN_UPDATE_INTERVAL'] = 0
+        self.assertTrue(u.touch())
+
     def test_follow(self):
         u1 = User(username='john', email='john@example.com')
         u2 = User(username='susan', email='susan@example.com')
@@ -62,6 +160,68 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(u1.following_count(), 0)
         self.assertEqual(u2.followers_count(), 0)
 
+    def test_following_among(self):
+        users = [User(username=f'user{i}', email=f'user{i}@example.com')
+                 for i in range(4)]
+        db.session.add_all(users)
+        db.session.commit()
+        u0, u1, u2, u3 = users
+        u0.follow(u1)
+        u0.follow(u3)
+        db.session.commit()
+        # refresh the expired objects before counting queries
+        ids = [u.id for u in users]
+
+        with self.app.test_request_context():
+            with QueryCounter() as counter:
+                self.assertEqual(u0.following_among(users), {u1.id, u3.id})
+                self.assertEqual(u0.following_among(ids[2:]), {u3.id})
+                self.assertTrue(u0.is_following(u1))
+                self.assertFalse(u0.is_following(u2))
+            self.assertEqual(counter.count, 1)
+
+            # follow/unfollow keep the memoized answers current
+            u0.unfollow(u1)
+            u0.follow(u2)
+            self.assertEqual(u0.following_among(users), {u2.id, u3.id})
+            db.session.commit()
+
+    def test_follow_counts_before_commit(self):
+        users = [User(username=f'user{i}', email=f'user{i}@example.com',
+                      high_fanout=True) for i in range(3)]
+        db.session.add_all(users)
+        db.session.commit()
+        u0, u1, u2 = users
+
+        with self.app.test_request_context():
+            # with memoized answers and high-fanout authors nothing else
+            # flushes between the two follows
+            u0.following_among(users)
+            u0.follow(u1)
+            u0.follow(u2)
+            self.assertEqual(u0.following_count(), 2)
+            self.assertEqual(u1.followers_count(), 1)
+            db.session.commit()
+        self.assertEqual(u0.following_count(), 2)
+
+    def test_reconcile_follow_counts(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        u1.follow(u2)
+        db.session.commit()
+        self.assertEqual(User.reconcile_follow_counts(), 0)
+
+        u1.num_following = 5
+        u2.num_followers = 0
+        db.session.commit()
+        self.assertEqual(User.reconcile_follow_counts(), 2)
+        db.session.commit()
+        self.assertEqual(u1.following_count(), 1)
+        self.assertEqual(u2.followers_count(), 1)
+        self.assertEqual(u1.followers_count(), 0)
+
     def test_follow_posts(self):
         # create four users
         u1 = User(username='john', email='john@example.com')
@@ -100,6 +260,938 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(f3, [p3, p4])
         self.assertEqual(f4, [p4])
 
+    def test_home_timeline(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        now = datetime.now(timezone.utc)
+        p1 = Post(body="post from john", author=u1,
+                  time_stamp=now + timedelta(seconds=1))
+        p2 = Post(body="post from susan", author=u2,
+                  time_stamp=now + timedelta(seconds=2))
+        db.session.add_all([p1, p2])
+        for post in (p1, p2):
+            post.fan_out()
+        db.session.commit()
+
+        # following backfills the timeline with older posts
+        u1.follow(u2)
+        db.session.commit()
+        self.assertEqual(db.session.scalars(u1.home_timeline()).all(),
+                         [p2, p1])
+
+        # new posts are fanned out to followers
+        p3 = Post(body="post from susan", author=u2,
+                  time_stamp=now + timedelta(seconds=3))
+        db.session.add(p3)
+        p3.fan_out()
+        db.session.commit()
+        self.assertEqual(db.session.scalars(u1.home_timeline()).all(),
+                         [p3, p2, p1])
+        self.assertEqual(db.session.scalars(u1.home_timeline()).all(),
+                         db.session.scalars(u1.following_posts()).all())
+
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertEqual(db.session.scalars(u1.home_timeline()).all(), [p1])
+
+        # a full rebuild gives the same result as the incremental path
+        u3.follow(u2)
+        User.rebuild_timelines()
+        db.session.commit()
+        self.assertEqual(db.session.scalars(u3.home_timeline()).all(),
+                         [p3, p2])
+
+    def test_home_timeline_high_fanout(self):
+        self.app.config['TIMELINE_FANOUT_LIMIT'] = 1
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+        u1.follow(u3)
+        u2.follow(u3)
+        db.session.commit()
+
+        now = datetime.now(timezone.utc)
+        p1 = Post(body="post from mary", author=u3,
+                  time_stamp=now + timedelta(seconds=1))
+        db.session.add(p1)
+        p1.fan_out()
+        db.session.commit()
+
+        # mary has more followers than the limit, so she is read on pull
+        self.assertTrue(u3.high_fanout)
+        self.assertEqual(db.session.scalars(u1.home_timeline()).all(), [p1])
+        self.assertEqual(db.session.scalars(u2.home_timeline()).all(), [p1])
+        self.assertEqual(db.session.scalars(u3.home_timeline()).all(), [p1])
+
+
+class KeysetPaginationCase(AppTestCase):
+    def test_cursor_round_trip(self):
+        now = datetime(2025, 2, 4, 19, 22, 4, 89172)
+        self.assertEqual(decode_cursor(encode_cursor(now, 42)), (now, 42))
+        self.assertIsNone(decode_cursor('not-a-cursor'))
+        self.assertIsNone(decode_cursor(None))
+
+    def test_keyset_paginate(self):
+        u = User(username='john', email='john@example.com')
+        now = datetime.now(timezone.utc)
+        # two posts share a time stamp to exercise the id tie-breaker
+        posts = [Post(body=f"post {i}", author=u,
+                      time_stamp=now + timedelta(seconds=min(i, 3)))
+                 for i in range(5)]
+        db.session.add_all(posts)
+        db.session.commit()
+        newest_first = sorted(posts, key=lambda p: (p.time_stamp, p.id),
+                              reverse=True)
+        query = sa.select(Post).order_by(Post.time_stamp.desc())
+
+        page1 = keyset_paginate(query, Post.time_stamp, Post.id, 2)
+        self.assertEqual(page1.items, newest_first[:2])
+        self.assertTrue(page1.has_next)
+        self.assertIsNone(page1.prev_cursor)
+
+        page2 = keyset_paginate(query, Post.time_stamp, Post.id, 2,
+                                before=page1.next_cursor)
+        self.assertEqual(page2.items, newest_first[2:4])
+
+        page3 = keyset_paginate(query, Post.time_stamp, Post.id, 2,
+                                before=page2.next_cursor)
+        self.assertEqual(page3.items, newest_first[4:])
+        self.assertIsNone(page3.next_cursor)
+
+        back = keyset_paginate(query, Post.time_stamp, Post.id, 2,
+                               after=page3.prev_cursor)
+        self.assertEqual(back.items, newest_first[2:4])
+        back = keyset_paginate(query, Post.time_stamp, Post.id, 2,
+                               after=back.prev_cursor)
+        self.assertEqual(back.items, newest_first[:2])
+        self.assertIsNone(back.prev_cursor)
+
+
+class FeedQueryCase(AppTestCase):
+    def render_feed(self, query, per_page):
+        # start from an empty identity map so authors are not already loaded
+        db.session.expunge_all()
+        with QueryCounter() as counter:
+            posts = keyset_paginate(query, Post.time_stamp, Post.id,
+                                    per_page).items
+            for post in posts:
+                post.author.username
+                post.author.avatar(70)
+        self.assertEqual(len(posts), per_page)
+        return counter.count
+
+    def test_feed_loads_authors_in_bulk(self):
+        users = [User(username=f'user{i}', email=f'user{i}@example.com')
+                 for i in range(6)]
+        reader = users[0]
+        db.session.add_all(users)
+        db.session.commit()
+        now = datetime.now(timezone.utc)
+        for i, author in enumerate(users):
+            if author != reader:
+                reader.follow(author)
+            post = Post(body=f"post {i}", author=author,
+                        time_stamp=now + timedelta(seconds=i))
+            db.session.add(post)
+            post.fan_out()
+        db.session.commit()
+        reader_id = reader.id
+
+        # one statement for the posts and one for their authors,
+        # whatever the page size
+        for per_page in (2, 6):
+            self.assertEqual(self.render_feed(Post.feed(), per_page), 2)
+            reader = db.session.get(User, reader_id)
+            self.assertEqual(
+                self.render_feed(reader.home_timeline(), per_page), 2)
+            self.assertEqual(
+                self.render_feed(reader.following_posts(), per_page), 2)
+
+    def test_home_timeline_pages(self):
+        self.app.config['TIMELINE_FANOUT_LIMIT'] = 1
+        reader = User(username='john', email='john@example.com')
+        pushed = User(username='susan', email='susan@example.com')
+        pulled = User(username='mary', email='mary@example.com')
+        db.session.add_all([reader, pushed, pulled])
+        db.session.commit()
+        reader.follow(pushed)
+        reader.follow(pulled)
+        pushed.follow(pulled)
+        db.session.commit()
+        now = datetime.now(timezone.utc)
+        posts = []
+        for i in range(7):
+            post = Post(body=f"post {i}", author=(pushed, pulled)[i % 2],
+                        time_stamp=now + timedelta(seconds=i))
+            db.session.add(post)
+            post.fan_out()
+            posts.append(post)
+        db.session.commit()
+        self.assertTrue(pulled.high_fanout)
+        newest_first = posts[::-1]
+
+        # each side is cut at the cursor and merged into the same pages
+        seen, cursor = [], None
+        while True:
+            page = keyset_paginate(reader.home_timeline, Post.time_stamp,
+                                   Post.id, 3, before=cursor)
+            seen += page.items
+            if not page.has_next:
+                break
+            cursor = page.next_cursor
+        self.assertEqual(seen, newest_first)
+
+        page = keyset_paginate(reader.home_timeline, Post.time_stamp,
+                               Post.id, 3, after=page.prev_cursor)
+        self.assertEqual(page.items, newest_first[3:6])
+
+
+class TranslationCacheCase(AppTestCase):
+    def test_translate_is_cached(self):
+        translator = get_translator()
+        misses = metrics.get('translation_cache_misses')
+        self.assertEqual(translate('salam', 'fa', 'en'), '[en] salam')
+        self.assertEqual(translate('salam', 'fa', 'en'), '[en] salam')
+        self.assertEqual(translator.calls, 1)
+        self.assertEqual(metrics.get('translation_cache_misses'), misses + 1)
+
+        # a different language pair is a different entry
+        self.assertEqual(translate('salam', 'fa', 'de'), '[de] salam')
+        self.assertEqual(translator.calls, 2)
+
+        # the database tier survives losing the in-memory tier
+        self.app.extensions['translation_cache'].clear()
+        self.assertEqual(translate('salam', 'fa', 'en'), '[en] salam')
+        self.assertEqual(translator.calls, 2)
+
+    def test_translate_batch(self):
+        u = User(username='john', email='john@example.com')
+        p1 = Post(body='salam', author=u, language='fa')
+        p2 = Post(body='merci', author=u, language='fa')
+        p3 = Post(body='bonjour', author=u, language='fr')
+        db.session.add_all([p1, p2, p3])
+        db.session.commit()
+
+        client = self.login_client(u)
+        response = client.post('/translate/batch', json={'items': [
+            {'post_id': p1.id, 'dest_lang': 'en'},
+            {'post_id': p2.id, 'dest_lang': 'en'},
+            {'post_id': p3.id, 'dest_lang': 'en'},
+            {'post_id': 0, 'dest_lang': 'en'},
+        ]})
+        self.assertEqual(response.status_code, 200)
+        translations = {t['post_id']: t['text']
+                        for t in response.get_json()['translations']}
+        self.assertEqual(translations, {p1.id: '[en] salam',
+                                        p2.id: '[en] merci',
+                                        p3.id: '[en] bonjour'})
+        # one backend call per language pair
+        self.assertEqual(get_translator().calls, 2)
+
+        response = client.post('/translate/batch', json={'items': 'nope'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_translate_batch_anonymous(self):
+        response = self.app.test_client().post('/translate/batch', json={
+            'items': [{'post_id': 1, 'dest_lang': 'en'}]})
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response.headers['Location'].startswith(
+            '/auth/login'))
+        self.assertEqual(get_translator().calls, 0)
+
+    def test_async_translate_batch(self):
+        u = User(username='john', email='john@example.com')
+        p1 = Post(body='salam', author=u, language='fa')
+        p2 = Post(body='bonjour', author=u, language='fr')
+        db.session.add_all([p1, p2])
+        db.session.commit()
+
+        cookie = self.app.session_interface.get_signing_serializer(
+            self.app).dumps({'_user_id': u.get_id()})
+
+        def call(path, body, headers=((b'cookie',
+                                       f'session={cookie}'.encode()),)):
+            sent = []
+
+            async def receive():
+                return {'type': 'http.request', 'body': body}
+
+            async def send(message):
+                sent.append(message)
+
+            asyncio.run(AsyncApp(self.app)(
+                {'type': 'http', 'method': 'POST', 'path': path,
+                 'headers': list(headers)},
+                receive, send))
+            return sent[0]['status'], json.loads(sent[1]['body'])
+
+        status, data = call('/translate/batch', json.dumps({'items': [
+            {'post_id': p1.id, 'dest_lang': 'en'},
+            {'post_id': p2.id, 'dest_lang': 'en'},
+        ]}).encode())
+        self.assertEqual(status, 200)
+        self.assertEqual({t['post_id']: t['text']
+                          for t in data['translations']},
+                         {p1.id: '[en] salam', p2.id: '[en] bonjour'})
+        self.assertEqual(get_translator().calls, 2)
+
+        status, data = call('/translate', json.dumps({
+            'text': 'salam', 'source_lang': 'fa', 'dest_lang': 'en'
+        }).encode())
+        self.assertEqual((status, data), (200, {'text': '[en] salam'}))
+        # answered from the cache filled by the batch
+        self.assertEqual(get_translator().calls, 2)
+
+        status, _ = call('/translate/batch', b'{"items": "nope"}')
+        self.assertEqual(status, 400)
+        status, _ = call('/translate', b'not json')
+        self.assertEqual(status, 400)
+        # the batch endpoint needs a logged in user
+        status, _ = call('/translate/batch', b'{"items": []}', headers=())
+        self.assertEqual(status, 401)
+
+    def test_expired_translations(self):
+        translate('salam', 'fa', 'en')
+        row = db.session.scalar(sa.select(CachedTranslation))
+        row.created_at = datetime.now(timezone.utc) - timedelta(days=365)
+        db.session.commit()
+        self.app.extensions['translation_cache'].clear()
+
+        translate('salam', 'fa', 'en')
+        db.session.commit()
+        self.assertEqual(get_translator().calls, 2)
+        self.assertEqual(purge_expired_translations(), 0)
+
+        row.created_at = datetime.now(timezone.utc) - timedelta(days=365)
+        db.session.commit()
+        self.assertEqual(purge_expired_translations(), 1)
+
+
+class PretranslateCase(AppTestCase):
+    class config(TestConfig):
+        PRETRANSLATE_POSTS = True
+        PRETRANSLATE_WORKERS = 1
+        LANGUAGES = ['en', 'fa', 'de']
+
+    def add_post(self, body, language):
+        u = db.session.scalar(sa.select(User)) or \
+            User(username='john', email='john@example.com')
+        post = Post(body=body, author=u, language=language)
+        db.session.add(post)
+        pretranslate.enqueue_translations(post)
+        db.session.commit()
+        return post
+
+    def test_drain(self):
+        p1 = self.add_post('salam', 'fa')
+        p2 = self.add_post('dorood', 'fa')
+        self.assertEqual(
+            db.session.scalar(sa.select(sa.func.count(TranslationJob.id))), 4)
+
+        self.assertEqual(pretranslate.drain(), 4)
+        # one backend call per language pair
+        self.assertEqual(get_translator().calls, 2)
+        self.assertEqual(
+            stored_translations([(p1.id, 'en'), (p2.id, 'de')]),
+            {(p1.id, 'en'): '[en] salam', (p2.id, 'de'): '[de] dorood'})
+        self.assertEqual(pretranslate.drain(), 0)
+
+    def test_claim_jobs(self):
+        self.add_post('salam', 'fa')
+        self.add_post('dorood', 'fa')
+        first = pretranslate.claim_jobs(3)
+        self.assertEqual(len(first), 3)
+        # leased jobs are not claimed again
+        self.assertEqual(len(set(first) | set(pretranslate.claim_jobs(3))),
+                         4)
+        self.assertEqual(pretranslate.claim_jobs(3), [])
+
+    def test_detect_in_background(self):
+        u = User(username='john', email='john@example.com')
+        post = Post(body='سلام به همه، این اولین پست من است', author=u)
+        db.session.add(post)
+        db.session.commit()
+        detect_in_background(post).result()
+        db.session.expire_all()
+        self.assertEqual(post.language, 'fa')
+        # the detected language feeds the pre-translation queue
+        self.assertEqual(db.session.scalar(
+            sa.select(sa.func.count(TranslationJob.id))), 2)
+
+    def test_retry_and_replay(self):
+        self.app.config['PRETRANSLATE_MAX_ATTEMPTS'] = 2
+        self.app.config['PRETRANSLATE_RETRY_DELAY'] = 0
+        self.add_post('salam', 'fa')
+        translator = get_translator()
+
+        def broken(*args):
+            raise RuntimeError('DeepL is down')
+        translator.translate_many = broken
+
+        # without a retry delay both attempts run in the same drain
+        self.assertEqual(pretranslate.drain(), 4)
+        jobs = db.session.scalars(sa.select(TranslationJob)).all()
+        self.assertEqual({job.status for job in jobs}, {'failed'})
+        self.assertEqual(jobs[0].last_error, 'DeepL is down')
+        self.assertEqual(pretranslate.drain(), 0)
+
+        del translator.translate_many
+        self.assertEqual(pretranslate.replay_failed(), 2)
+        self.assertEqual(pretranslate.drain(), 2)
+        self.assertEqual(db.session.scalar(
+            sa.select(sa.func.count()).select_from(PostTranslation)), 2)
+
+
+class MailDispatcherCase(AppTestCase):
+    class config(TestConfig):
+        MAIL_RETRY_DELAY = 0
+        MAIL_BATCH_SIZE = 3
+
+    def tearDown(self):
+        get_dispatcher().shutdown()
+        super().tearDown()
+
+    def send(self, n):
+        for i in range(n):
+            send_email(f'Message {i}', ['susan@example.com'],
+                       'john@example.com', f'<p>{i}</p>', str(i))
+        get_dispatcher().join()
+
+    def test_send_email(self):
+        connections = []
+        connect = mail.connect
+
+        def counting_connect():
+            connections.append(1)
+            return connect()
+
+        with mock.patch.object(mail, 'connect', counting_connect), \
+                mail.record_messages() as outbox:
+            self.send(7)
+        self.assertEqual(sorted(msg.subject for msg in outbox),
+                         [f'Message {i}' for i in range(7)])
+        # messages are sent in batches over a shared connection
+        self.assertLess(len(connections), 7)
+        self.assertEqual(get_dispatcher().depth(), 0)
+
+    def test_retry(self):
+        send = flask_mail.Connection.send
+        failures = []
+
+        def flaky_send(conn, msg):
+            if not failures:
+                failures.append(msg)
+                raise smtplib.SMTPServerDisconnected('connection lost')
+            send(conn, msg)
+
+        with mock.patch.object(flask_mail.Connection, 'send', flaky_send), \
+                mail.record_messages() as outbox:
+            self.send(1)
+        self.assertEqual(len(failures), 1)
+        self.assertEqual([msg.subject for msg in outbox], ['Message 0'])
+
+
+class OutboxCase(AppTestCase):
+    class config(TestConfig):
+        MAIL_OUTBOX = True
+        MAIL_RETRY_DELAY = 0
+        MAIL_MAX_RETRIES = 1
+
+    def queue_emails(self, n):
+        for i in range(n):
+            send_email(f'Message {i}', ['susan@example.com'],
+                       'john@example.com', f'<p>{i}</p>', str(i))
+        db.session.commit()
+
+    def test_outbox(self):
+        self.queue_emails(3)
+        with mail.record_messages() as outbox:
+            self.assertEqual(process_outbox(limit=2), 2)
+            self.assertEqual(drain_outbox(), 1)
+        self.assertEqual(len(outbox), 3)
+        rows = db.session.scalars(sa.select(Outbox)).all()
+        self.assertEqual({row.status for row in rows}, {'sent'})
+        self.assertEqual(drain_outbox(), 0)
+
+    def test_email_composer(self):
+        users = [User(username=f'user{i}', email=f'user{i}@example.com')
+                 for i in range(3)]
+        composer = EmailComposer('email/notification', 'News')
+        messages = composer.compose(users, message='We moved!')
+        self.assertEqual([msg.recipients for msg in messages],
+                         [[u.email] for u in users])
+        self.assertIn('Dear user2,', messages[2].body)
+        self.assertIn('<p>We moved!</p>', messages[2].html)
+
+        send_messages_later(messages)
+        db.session.commit()
+        self.assertEqual(db.session.scalar(
+            sa.select(sa.func.count(Outbox.id))), 3)
+
+    def test_outbox_lease(self):
+        self.queue_emails(2)
+        self.assertEqual(len(claim_outbox(10)), 2)
+        # rows leased by another worker are not claimed again
+        self.assertEqual(claim_outbox(10), [])
+
+    def test_outbox_failure(self):
+        self.queue_emails(1)
+        with mock.patch.object(flask_mail.Connection, 'send',
+                               side_effect=smtplib.SMTPException('down')):
+            self.assertEqual(drain_outbox(), 2)
+        row = db.session.scalar(sa.select(Outbox))
+        self.assertEqual((row.status, row.attempts), ('failed', 2))
+
+
+class SearchCase(AppTestCase):
+    def check_backend(self):
+        u = User(username='john', email='john@example.com')
+        p1 = Post(body='The cat sat on the mat', author=u)
+        p2 = Post(body='A dog and a cat', author=u)
+        p3 = Post(body='Nothing to see here', author=u)
+        db.session.add_all([p1, p2, p3])
+        db.session.commit()
+        self.assertEqual(set(search_posts('cat', 10)), {p1.id, p2.id})
+        self.assertEqual(search_posts('CAT dog', 10), [p2.id])
+        self.assertEqual(search_posts('"', 10), [])
+
+        # edits and deletes follow the posts
+        p3.body = 'A cat after all'
+        db.session.delete(p1)
+        db.session.commit()
+        self.assertEqual(set(search_posts('cat', 10)), {p2.id, p3.id})
+
+        # rolled back changes never reach the index
+        db.session.add(Post(body='Another cat', author=u))
+        db.session.flush()
+        db.session.rollback()
+        self.assertEqual(len(search_posts('cat', 10)), 2)
+
+        self.assertEqual(search.reindex(chunk_size=1), 2)
+        self.assertEqual(set(search_posts('cat', 10)), {p2.id, p3.id})
+        self.assertEqual(len(search_posts('cat', 1)), 1)
+
+    def test_memory_backend(self):
+        self.app.config['SEARCH_BACKEND'] = 'memory'
+        self.check_backend()
+
+    def test_sqlite_backend(self):
+        # the default on SQLite, with the table made by db.create_all()
+        self.assertIsInstance(search.get_backend(), search.SQLiteSearch)
+        self.check_backend()
+
+    def test_unsupported_database(self):
+        with mock.patch.object(db.engine.dialect, 'name', 'mysql'):
+            with self.assertRaises(ValueError):
+                search.get_backend()
+            self.app.config['SEARCH_BACKEND'] = 'memory'
+            self.assertIsInstance(search.get_backend(), search.MemorySearch)
+
+
+class UsernameIndexCase(AppTestCase):
+    def test_complete_username(self):
+        names = ['susan', 'sue', 'Sam', 'john', 'suzy']
+        users = [User(username=name, email=f'{name}@example.com')
+                 for name in names]
+        db.session.add_all(users)
+        db.session.commit()
+        susan, sue, sam, john, suzy = users
+        john.follow(sue)
+        sam.follow(sue)
+        john.follow(suzy)
+        db.session.commit()
+
+        self.assertEqual(complete_username('su', 10),
+                         [('sue', 2), ('suzy', 1), ('susan', 0)])
+        self.assertEqual(complete_username('S', 2), [('sue', 2), ('suzy', 1)])
+        self.assertEqual(complete_username('x', 10), [])
+
+        # new users and renames are picked up on commit
+        db.session.add(User(username='sunny', email='sunny@example.com'))
+        susan.username = 'anna'
+        db.session.commit()
+        self.assertEqual([u for u, _ in complete_username('su', 10)],
+                         ['sue', 'suzy', 'sunny'])
+        self.assertEqual(complete_username('ann', 10), [('anna', 0)])
+
+        susan.username = 'zoe'
+        db.session.flush()
+        db.session.rollback()
+        self.assertEqual(complete_username('zo', 10), [])
+
+    def test_changes_during_rebuild(self):
+        susan = User(username='susan', email='susan@example.com')
+        sue = User(username='sue', email='sue@example.com')
+        db.session.add_all([susan, sue])
+        db.session.commit()
+        index = get_index()
+        self.assertEqual(index.complete('su', 1), [('susan', 0)])
+        self.assertEqual(len(index.complete('su', 10)), 2)
+
+        # changes made while the user table is being read are re-applied
+        # after the new lists are swapped in
+        execute = db.session.execute
+
+        def racing_execute(*args, **kwargs):
+            result = execute(*args, **kwargs)
+            index.add(100, 'sunny', 5)
+            index.remove(sue.id)
+            return result
+
+        with mock.patch.object(db.session, 'execute', racing_execute):
+            index.build()
+        self.assertEqual(index.complete('su', 10),
+                         [('sunny', 5), ('susan', 0)])
+        self.assertEqual(index._pending, [])
+
+
+class PageCacheCase(AppTestCase):
+    def test_cached_fragment(self):
+        calls = []
+
+        @cached_fragment('posts')
+        def feed():
+            calls.append(1)
+            return f'<p>{len(calls)}</p>'
+
+        with self.app.test_request_context('/explore?page=1'):
+            self.assertEqual(feed(), Markup('<p>1</p>'))
+            self.assertEqual(feed(), Markup('<p>1</p>'))
+        with self.app.test_request_context('/explore?page=2'):
+            self.assertEqual(feed(), Markup('<p>2</p>'))
+
+        # a new post invalidates every cached page
+        u = User(username='john', email='john@example.com')
+        db.session.add(Post(body='hello', author=u))
+        db.session.commit()
+        with self.app.test_request_context('/explore?page=1'):
+            self.assertEqual(feed(), Markup('<p>3</p>'))
+            self.assertEqual(feed(), Markup('<p>3</p>'))
+
+        # and so does renaming an author
+        u.username = 'johnny'
+        db.session.commit()
+        with self.app.test_request_context('/explore?page=1'):
+            self.assertEqual(feed(), Markup('<p>4</p>'))
+
+    def test_render_post(self):
+        u = User(username='john', email='john@example.com')
+        p = Post(body='hello', author=u, language='es')
+        db.session.add(p)
+        db.session.commit()
+        with self.app.test_request_context('/'):
+            g.locale = 'en'
+            html = render_post(p)
+            self.assertIn('john', html)
+            self.assertIn('translation1', html)
+            self.assertEqual(render_post(p), html)
+            self.assertEqual(len(self.app.extensions['post_fragments']), 1)
+
+            # a profile edit renders the author's posts again
+            u.username = 'johnny'
+            u.profile_version += 1
+            db.session.commit()
+            self.assertIn('johnny', render_post(p))
+
+            # and so does a reader with another locale
+            g.locale = 'es'
+            self.assertNotIn('translation1', render_post(p))
+
+
+class IdentityCacheCase(AppTestCase):
+    class config(TestConfig):
+        SECRET_KEY = 'test'
+
+    def load(self, user_id):
+        # Every request starts with an empty session
+        db.session.remove()
+        return load_user(user_id)
+
+    def test_load_user(self):
+        u = User(username='john', email='john@example.com')
+        u.set_password('cat')
+        db.session.add(u)
+        db.session.commit()
+        user_id = u.get_id()
+        self.assertEqual(user_id, f'{u.id}:0')
+
+        with self.app.test_request_context('/'):
+            self.assertEqual(self.load(user_id).username, 'john')
+            with QueryCounter() as counter:
+                u = self.load(user_id)
+                self.assertEqual(u.username, 'john')
+            self.assertEqual(counter.count, 0)
+            # the password hash is never cached
+            self.assertTrue(u.check_password('cat'))
+
+            # a cached user can be changed like any other
+            u.about_me = 'hello'
+            db.session.commit()
+            with QueryCounter() as counter:
+                self.assertEqual(self.load(user_id).about_me, 'hello')
+            self.assertEqual(counter.count, 1)
+
+            # sessions keyed with an older profile version are moved on
+            u = self.load(user_id)
+            u.profile_version += 1
+            db.session.commit()
+            with QueryCounter() as counter:
+                self.assertEqual(self.load(user_id).profile_version, 1)
+                self.assertEqual(session['_user_id'], user_id[:-1] + '1')
+                self.load(session['_user_id'])
+            self.assertEqual(counter.count, 1)
+
+    def test_logout(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        with self.app.test_request_context('/'):
+            self.load(u.get_id())
+        self.assertEqual(len(self.app.extensions['identity_cache']), 1)
+        with self.app.test_request_context('/auth/logout'):
+            login_user(u)
+            self.app.view_functions['auth.logout']()
+        self.assertEqual(len(self.app.extensions['identity_cache']), 0)
+
+
+class SeedCase(AppTestCase):
+    def test_seed(self):
+        counts = seed(50, 200, max_following=10, password='cat')
+        self.assertEqual(counts['user'], 50)
+        self.assertEqual(counts['post'], 200)
+        self.assertEqual(counts['followers'], db.session.scalar(
+            sa.select(sa.func.count()).select_from(followers)))
+        # the counters are already right
+        self.assertEqual(User.reconcile_follow_counts(), 0)
+        # the indexes dropped while inserting are back
+        self.assertIn('ix_post_user_id_time_stamp_id',
+                      {index['name'] for index in
+                       sa.inspect(db.session.connection())
+                       .get_indexes('post')})
+
+        u = db.session.get(User, 1)
+        self.assertTrue(u.check_password('cat'))
+        self.assertEqual(u.avatar(36), User.avatars([u], 36)[0])
+        posts = db.session.scalars(u.home_timeline()).all()
+        self.assertTrue(posts)
+        self.assertIsInstance(posts[0].time_stamp, datetime)
+
+        # seeding again adds more users after the existing ones
+        self.assertEqual(seed(10, 0)['user'], 10)
+        self.assertEqual(db.session.get(User, 60).username, 'user60')
+
+
+class LoginCase(AppTestCase):
+    class config(TestConfig):
+        SECRET_KEY = 'test'
+        WTF_CSRF_ENABLED = False
+        LOGIN_MAX_FAILURES_PER_USERNAME = 3
+        LOGIN_MAX_FAILURES_PER_IP = 5
+
+    def setUp(self):
+        super().setUp()
+        for username in ('john', 'susan'):
+            u = User(username=username, email=f'{username}@example.com')
+            u.set_password('cat')
+            db.session.add(u)
+        db.session.commit()
+
+    def login(self, username, password, client_addr=None):
+        headers = {'X-Forwarded-For': client_addr} if client_addr else {}
+        return self.app.test_client().post('/auth/login', data={
+            'username': username, 'password': password}, headers=headers)
+
+    def test_throttling(self):
+        for _ in range(3):
+            self.assertEqual(self.login('john', 'dog').status_code, 302)
+        with mock.patch.object(User, 'check_password') as check_password:
+            # rejected before the password is even checked
+            self.assertEqual(self.login('John', 'cat').status_code, 429)
+            check_password.assert_not_called()
+
+        # other users are still checked from the same address...
+        response = self.login('susan', 'dog')
+        self.assertEqual(response.headers['Location'], '/auth/login')
+        # ...until the address itself is over its limit
+        self.login('nobody', 'dog')
+        self.assertEqual(self.login('susan', 'cat').status_code, 429)
+
+    def test_throttling_behind_proxy(self):
+        class ProxyConfig(TestConfig):
+            PROXY_FIX_X_FOR = 1
+
+        self.assertIsInstance(create_app(ProxyConfig).wsgi_app, ProxyFix)
+        self.app.wsgi_app = ProxyFix(self.app.wsgi_app, x_for=1)
+        for username in ('a', 'b', 'c', 'd', 'e'):
+            self.login(username, 'dog', '10.0.0.1')
+        self.assertEqual(self.login('john', 'cat', '10.0.0.1').status_code,
+                         429)
+        # clients behind the proxy are told apart by X-Forwarded-For
+        response = self.login('john', 'cat', '10.0.0.2')
+        self.assertEqual(response.headers['Location'], '/index')
+
+    def test_sliding_window(self):
+        window = SlidingWindow(limit=2, window=60)
+        with mock.patch('app.auth.throttle.monotonic') as monotonic:
+            monotonic.return_value = 0
+            window.hit('john')
+            monotonic.return_value = 30
+            window.hit('john')
+            self.assertTrue(window.blocked('john'))
+            self.assertFalse(window.blocked('susan'))
+            # the first failure leaves the window
+            monotonic.return_value = 61
+            self.assertFalse(window.blocked('john'))
+            window.reset('john')
+            monotonic.return_value = 200
+            window.hit('susan')
+            # keys without recent events were swept out
+            self.assertEqual(list(window._events), ['susan'])
+
+    def test_rehash_on_login(self):
+        self.app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:2000'
+        u = db.session.scalar(sa.select(User).where(User.username == 'john'))
+        self.assertTrue(needs_rehash(u.password_hash))
+        self.assertEqual(self.login('john', 'cat').status_code, 302)
+        db.session.refresh(u)
+        self.assertTrue(u.password_hash.startswith('pbkdf2:sha256:2000$'))
+        self.assertFalse(needs_rehash(u.password_hash))
+        self.assertTrue(u.check_password('cat'))
+
+    def test_process_pool(self):
+        self.app.config['PASSWORD_HASH_WORKERS'] = 1
+        u = User(username='david', email='david@example.com')
+        u.set_password('cat')
+        self.assertTrue(u.check_password('cat'))
+        self.assertFalse(u.check_password('dog'))
+
+
+class EngineCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+        class FileConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = \
+                f'sqlite:///{self.tmpdir.name}/app.db'
+            SQLALCHEMY_ENGINE_OPTIONS = {'pool_size': 2, 'max_overflow': 0}
+
+        self.app = create_app(FileConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+
+    def tearDown(self):
+        db.session.remove()
+        db.engine.dispose()
+        self.app_context.pop()
+        self.tmpdir.cleanup()
+
+    def test_sqlite_pragmas(self):
+        with db.engine.connect() as connection:
+            self.assertEqual(connection.exec_driver_sql(
+                'PRAGMA journal_mode').scalar(), 'wal')
+            self.assertEqual(connection.exec_driver_sql(
+                'PRAGMA busy_timeout').scalar(), 5000)
+
+    def test_pool_stats(self):
+        self.assertIsInstance(db.engine.pool, TimedQueuePool)
+        checkouts = metrics.get('db_pool_checkouts')
+        saturated = metrics.get('db_pool_saturated')
+        with db.engine.connect():
+            self.assertEqual(pool_stats()['saturation'], 0.5)
+            with db.engine.connect():
+                stats = pool_stats()
+                self.assertEqual(stats['checked_out'], 2)
+                self.assertEqual(stats['saturation'], 1)
+        self.assertEqual(metrics.get('db_pool_checkouts'), checkouts + 2)
+        self.assertEqual(metrics.get('db_pool_saturated'), saturated + 1)
+
+    def test_in_memory_database(self):
+        # pool options don't apply to the single in-memory connection
+        class MemoryConfig(TestConfig):
+            SQLALCHEMY_ENGINE_OPTIONS = {'pool_size': 2}
+
+        app = create_app(MemoryConfig)
+        with app.app_context():
+            self.assertNotIsInstance(db.engine.pool, QueuePool)
+
+
+class InstrumentationCase(AppTestCase):
+    def test_server_timing(self):
+        u = User(username='john', email='john@example.com')
+        p = Post(body='salam', author=u, language='fa')
+        db.session.add(p)
+        db.session.commit()
+
+        response = self.login_client(u).post('/translate/batch', json={
+            'items': [{'post_id': p.id, 'dest_lang': 'en'}]})
+        timings = dict(
+            timing.split(';', 1)[0:2] for timing in
+            response.headers['Server-Timing'].split(', '))
+        self.assertEqual(set(timings), {'sql', 'translate', 'total'})
+        # one backend call
+        self.assertTrue(timings['translate'].endswith('desc="1"'))
+
+    def test_template_timing(self):
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            g.locale = 'en'
+            render_template('_feed.html', posts=[], next_url=None,
+                            prev_url=None)
+            _, count = g.timings['template']
+            self.assertEqual(count, 1)
+
+    def test_metrics_endpoint(self):
+        # off by default
+        response = self.app.test_client().get('/metrics')
+        self.assertEqual(response.status_code, 404)
+
+        class MetricsConfig(TestConfig):
+            METRICS_ENDPOINT = True
+            METRICS_TOKEN = 'secret'
+
+        app = create_app(MetricsConfig)
+        client = app.test_client()
+        client.post('/translate/batch', json={'items': []})
+        self.assertEqual(client.get('/metrics').status_code, 401)
+        response = client.get('/metrics',
+                              headers={'Authorization': 'Bearer secret'})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('# TYPE microblog_requests counter',
+                      response.get_data(as_text=True))
+
+    def test_metrics_mail_queue_depth(self):
+        class MetricsConfig(TestConfig):
+            METRICS_ENDPOINT = True
+
+        app = create_app(MetricsConfig)
+        client = app.test_client()
+        body = client.get('/metrics').get_data(as_text=True)
+        self.assertIn('microblog_mail_queue_depth 0', body)
+
+        dispatcher = get_dispatcher(app)
+        try:
+            body = client.get('/metrics').get_data(as_text=True)
+            self.assertIn('# TYPE microblog_mail_queue_depth gauge', body)
+            self.assertIn(f'microblog_mail_queue_depth {dispatcher.depth()}',
+                          body)
+        finally:
+            dispatcher.shutdown()
+
+    def test_slow_query_log(self):
+        class SlowConfig(TestConfig):
+            SLOW_QUERY_THRESHOLD = 0
+
+        app = create_app(SlowConfig)
+        with app.app_context():
+            with self.assertLogs('app.slow_queries', 'WARNING') as logs:
+                db.session.execute(sa.text('SELECT 1'))
+        self.assertEqual(json.loads(logs.records[0].getMessage())[
+            'statement'], 'SELECT 1')
+
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)